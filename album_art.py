@@ -0,0 +1,457 @@
+import asyncio
+import io
+import json
+import math
+import mmap
+import os
+import struct
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import aiohttp
+import pyray as pr
+from PIL import Image
+from raylib import ffi
+
+import hub_constants
+from file_utils import atomic_write
+
+# raw cover format: a small header, then tightly packed RGBA rows ready for upload
+RAW_MAGIC = b"PDHR"
+RAW_VERSION = 1
+RAW_HEADER = struct.Struct("<4sHHH")  # magic, version, width, height
+
+
+class AlbumCover:
+    """Decoded, resized cover pixels ready for a texture upload"""
+
+    def __init__(self, width, height, pixels):
+        self.width = width
+        self.height = height
+        self.pixels = pixels  # tightly packed RGBA bytes, or a view of a mapped file
+
+
+def cover_url(album):
+    # spotify lists 640, 300 and 64px images, we want the biggest one
+    return sorted(album["images"], key=lambda x: x["height"])[-1]["url"]
+
+
+def write_raw_cover(path, cover):
+    header = RAW_HEADER.pack(RAW_MAGIC, RAW_VERSION, cover.width, cover.height)
+    atomic_write(path, header + bytes(cover.pixels))
+
+
+def read_raw_cover(path):
+    """map a raw cover, its pixels are paged in straight from the file during the
+    texture upload instead of being decoded and copied"""
+    with open(path, "rb") as f:
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    if len(data) < RAW_HEADER.size:
+        raise ValueError("truncated raw cover")
+    magic, version, width, height = RAW_HEADER.unpack_from(data)
+    if magic != RAW_MAGIC or version != RAW_VERSION:
+        raise ValueError("not a raw cover")
+    if len(data) != RAW_HEADER.size + width * height * 4:
+        raise ValueError("raw cover size doesn't match its header")
+    return AlbumCover(width, height, memoryview(data)[RAW_HEADER.size :])
+
+
+def decode_cover(img_data, path, raw_path):
+    """runs in the executor: decode and thumbnail the cover, keeping the jpg as the
+    archival copy and the pixels as a raw cover. Returns the pixels"""
+    with Image.open(io.BytesIO(img_data)) as im:
+        im.thumbnail(hub_constants.ALBUM_RESOLUTION)
+        im.save(path)
+        rgba = im.convert("RGBA")
+        cover = AlbumCover(rgba.width, rgba.height, rgba.tobytes())
+    write_raw_cover(raw_path, cover)
+    return cover
+
+
+def decode_cached_cover(path, raw_path):
+    """runs in the executor: map the raw cover, rebuilding it from the archival jpg
+    if it is missing or unreadable"""
+    try:
+        return read_raw_cover(raw_path)
+    except (OSError, ValueError):
+        pass
+    with Image.open(path) as im:
+        rgba = im.convert("RGBA")
+        cover = AlbumCover(rgba.width, rgba.height, rgba.tobytes())
+    write_raw_cover(raw_path, cover)
+    return cover
+
+
+class AlbumArtCache:
+    """Size-bounded cover cache in IMAGE_CACHE_DIR. An index file tracks the size and
+    last access time of every cover so the least recently used ones can be evicted
+    once the cache grows past max_bytes."""
+
+    INDEX_FILE = "index.json"
+
+    def __init__(
+        self,
+        directory=hub_constants.IMAGE_CACHE_DIR,
+        max_bytes=hub_constants.IMAGE_CACHE_MAX_BYTES,
+    ):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.index_path = os.path.join(directory, self.INDEX_FILE)
+        self.entries = {}  # album_id: {"size", "download_size", "last_access"}
+        self.dirty = False
+        self.hits = 0
+        self.misses = 0
+        self.saved_bytes = 0  # network traffic avoided by hits
+
+    def path(self, album_id):
+        return os.path.join(self.directory, f"{album_id}.jpg")
+
+    def raw_path(self, album_id):
+        return os.path.join(self.directory, f"{album_id}.rgba")
+
+    def files_size(self, album_id):
+        """the jpg and its raw cover, if there is one yet"""
+        size = os.path.getsize(self.path(album_id))
+        if os.path.exists(self.raw_path(album_id)):
+            size += os.path.getsize(self.raw_path(album_id))
+        return size
+
+    def load(self):
+        os.makedirs(self.directory, exist_ok=True)
+        try:
+            with open(self.index_path, "r", encoding="utf-8") as f:
+                self.entries = json.load(f)
+        except FileNotFoundError:
+            self.entries = {}
+        except ValueError:
+            print("Album art cache index is corrupt, rebuilding it")
+            self.entries = {}
+        # forget entries whose file is gone, adopt covers cached before the index existed
+        for album_id in list(self.entries):
+            if not os.path.exists(self.path(album_id)):
+                del self.entries[album_id]
+        for filename in os.listdir(self.directory):
+            album_id, ext = os.path.splitext(filename)
+            if ext == ".jpg" and album_id not in self.entries:
+                self.entries[album_id] = {
+                    "size": self.files_size(album_id),
+                    "download_size": 0,
+                    "last_access": 0,
+                }
+        self.dirty = True
+        self.evict()
+        self.save()
+
+    def save(self):
+        if self.dirty:
+            atomic_write(self.index_path, json.dumps(self.entries))
+            self.dirty = False
+
+    @property
+    def total_bytes(self):
+        return sum(entry["size"] for entry in self.entries.values())
+
+    def lookup(self, album_id):
+        """returns the cached cover path, or None if it has to be downloaded"""
+        entry = self.entries.get(album_id)
+        if entry and os.path.exists(self.path(album_id)):
+            entry["last_access"] = time.time()
+            self.dirty = True
+            self.hits += 1
+            self.saved_bytes += entry["download_size"]
+            return self.path(album_id)
+        self.entries.pop(album_id, None)
+        self.misses += 1
+        return None
+
+    def store(self, album_id, download_size=0):
+        """record a cover that was just written to self.path(album_id)"""
+        self.entries[album_id] = {
+            "size": self.files_size(album_id),
+            "download_size": download_size,
+            "last_access": time.time(),
+        }
+        self.dirty = True
+        self.evict(keep=album_id)
+        self.save()
+
+    def evict(self, keep=None):
+        total = self.total_bytes
+        by_age = sorted(self.entries, key=lambda k: self.entries[k]["last_access"])
+        for album_id in by_age:
+            if total <= self.max_bytes:
+                break
+            if album_id == keep:
+                continue
+            total -= self.entries.pop(album_id)["size"]
+            self.dirty = True
+            for path in (self.path(album_id), self.raw_path(album_id)):
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+
+    def update_size(self, album_id):
+        """account for a raw cover rebuilt after the entry was stored"""
+        entry = self.entries.get(album_id)
+        if entry:
+            size = self.files_size(album_id)
+            if size != entry["size"]:
+                entry["size"] = size
+                self.dirty = True
+
+    def stats(self):
+        return (
+            f"art cache: {self.hits} hits, {self.misses} misses, "
+            f"{self.saved_bytes // 1024}KB saved"
+        )
+
+
+class CoverSlot:
+    """A cover's place in an atlas page"""
+
+    def __init__(self, page, x, y, width, height):
+        self.page = page
+        self.source = pr.Rectangle(x, y, width, height)
+        self.width = width
+        self.height = height
+
+    def draw(self, x, y, scale=1):
+        """draw the cover with its top left at x, y. Covers on the same page batch"""
+        pr.draw_texture_pro(
+            self.page,
+            self.source,
+            pr.Rectangle(x, y, self.width * scale, self.height * scale),
+            pr.Vector2(0, 0),
+            0,
+            pr.WHITE,
+        )
+
+
+class AlbumArtAtlas:
+    """Album covers packed into shared atlas textures with one ALBUM_RESOLUTION slot
+    per cover, so cover draws bind one texture and batch, and GPU memory is capped at
+    a page of slots. Slots are refcounted and shared between tracks on the same
+    album. Unreferenced covers stay resident until their slot is the least recently
+    used one and a new cover needs it. Another page is only added when every slot
+    is in use. Prefetched covers are preloaded into spare slots without a
+    reference, so a track change to a queued album needs no upload."""
+
+    def __init__(
+        self,
+        slots_per_page=hub_constants.ALBUM_ATLAS_SLOTS,
+        slot_size=hub_constants.ALBUM_RESOLUTION,
+    ):
+        self.slot_width, self.slot_height = slot_size
+        self.slots_per_page = slots_per_page
+        # the squarest grid with exactly slots_per_page cells
+        smallest = math.ceil(math.sqrt(slots_per_page))
+        self.columns = next(
+            columns
+            for columns in range(smallest, slots_per_page + 1)
+            if slots_per_page % columns == 0
+        )
+        self.rows = slots_per_page // self.columns
+        self.pages = []  # textures
+        self.free = []  # (page, slot index) not holding any cover
+        self.slots = OrderedDict()  # album_id: [CoverSlot, refcount, location]
+
+    def add_page(self):
+        image = pr.gen_image_color(
+            self.columns * self.slot_width, self.rows * self.slot_height, pr.BLANK
+        )
+        self.pages.append(pr.load_texture_from_image(image))
+        pr.unload_image(image)
+        page = len(self.pages) - 1
+        self.free.extend((page, i) for i in range(self.slots_per_page))
+
+    def allocate(self, grow=True):
+        """a free slot, else the least recently used unreferenced one. Adds a page
+        when every slot is referenced, unless grow is False, then returns None"""
+        if self.free:
+            return self.free.pop(0)
+        for album_id, (_, refcount, location) in self.slots.items():
+            if refcount == 0:  # least recently used first
+                del self.slots[album_id]
+                return location
+        if self.pages and not grow:
+            return None
+        self.add_page()
+        return self.free.pop(0)
+
+    def upload(self, location, cover):
+        """copy decoded cover pixels into a slot. Must be called from the render loop"""
+        if cover.width > self.slot_width or cover.height > self.slot_height:
+            return None  # bigger than ALBUM_RESOLUTION, doesn't fit a slot
+        page, index = location
+        x = (index % self.columns) * self.slot_width
+        y = (index // self.columns) * self.slot_height
+        texture = self.pages[page]
+        pr.update_texture_rec(
+            texture,
+            pr.Rectangle(x, y, cover.width, cover.height),
+            ffi.from_buffer(cover.pixels),
+        )
+        return CoverSlot(texture, x, y, cover.width, cover.height)
+
+    def acquire(self, album_id, cover=None):
+        """returns the album's CoverSlot and takes a reference to it. If it isn't
+        resident it is uploaded from cover, or None is returned when there is no
+        cover yet"""
+        entry = self.slots.get(album_id)
+        if entry is None:
+            if cover is None:
+                return None
+            location = self.allocate()
+            slot = self.upload(location, cover)
+            if slot is None:
+                self.free.append(location)
+                return None
+            entry = [slot, 0, location]
+            self.slots[album_id] = entry
+        entry[1] += 1
+        self.slots.move_to_end(album_id)
+        return entry[0]
+
+    def preload(self, album_id, cover):
+        """upload a prefetched cover without taking a reference. Never adds a page
+        for it, so a full atlas just skips the preload"""
+        if album_id in self.slots:
+            return
+        location = self.allocate(grow=False)
+        if location is None:
+            return
+        slot = self.upload(location, cover)
+        if slot is None:
+            self.free.append(location)
+            return
+        self.slots[album_id] = [slot, 0, location]
+
+    def release(self, album_id):
+        entry = self.slots.get(album_id)
+        if entry:
+            entry[1] = max(0, entry[1] - 1)
+
+    def clear(self):
+        for texture in self.pages:
+            pr.unload_texture(texture)
+        self.pages = []
+        self.free = []
+        self.slots.clear()
+
+
+class AlbumArtLoader:
+    """Downloads and resizes album covers without blocking the render loop.
+    The download happens on the aiohttp session and the PIL work in an executor, so
+    the render loop only has to upload the finished pixels. Recently decoded covers
+    are kept in memory so prefetched or revisited albums show up immediately."""
+
+    def __init__(self):
+        self.cache = AlbumArtCache()
+        self.session = None
+        self.executor = ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix="album-art"
+        )
+        self.pending = {}  # album_id: asyncio.Task
+        self.decoded = OrderedDict()  # album_id: AlbumCover
+        self.prefetch_queue = asyncio.Queue()
+        self.prefetch_queued = set()
+        self.prefetch_task = None
+        self.on_decoded = None  # optional callback(album_id, cover)
+
+    async def start(self):
+        self.cache.load()
+        self.session = aiohttp.ClientSession(
+            timeout=aiohttp.ClientTimeout(total=hub_constants.ALBUM_ART_TIMEOUT)
+        )
+        self.prefetch_task = asyncio.create_task(self.prefetch_loop())
+
+    async def close(self):
+        if self.prefetch_task:
+            self.prefetch_task.cancel()
+        for task in list(self.pending.values()):
+            task.cancel()
+        if self.session:
+            await self.session.close()
+        self.executor.shutdown(wait=False)
+        self.cache.save()
+        print(self.cache.stats())
+
+    def stats(self):
+        return self.cache.stats()
+
+    def request(self, album):
+        """returns a future resolving to an AlbumCover (or None on failure).
+        Requests for an album that is already loading share the same task, and
+        albums that are still decoded in memory resolve immediately"""
+        album_id = album["id"].strip()
+        cover = self.decoded.get(album_id)
+        if cover:
+            self.decoded.move_to_end(album_id)
+            future = asyncio.get_running_loop().create_future()
+            future.set_result(cover)
+            return future
+        task = self.pending.get(album_id)
+        if task is None:
+            task = asyncio.create_task(self.load(album_id, album))
+            self.pending[album_id] = task
+            task.add_done_callback(lambda _: self.pending.pop(album_id, None))
+        return task
+
+    def prefetch(self, albums):
+        """queue covers for upcoming albums. They are loaded one at a time in the
+        background, and only while nothing else is loading"""
+        for album in albums:
+            album_id = album["id"].strip()
+            if (
+                album_id in self.decoded
+                or album_id in self.pending
+                or album_id in self.prefetch_queued
+            ):
+                continue
+            self.prefetch_queued.add(album_id)
+            self.prefetch_queue.put_nowait(album)
+
+    async def prefetch_loop(self):
+        while True:
+            album = await self.prefetch_queue.get()
+            # let on-screen covers go first
+            while self.pending:
+                await asyncio.wait(list(self.pending.values()))
+            await self.request(album)
+            self.prefetch_queued.discard(album["id"].strip())
+
+    async def load(self, album_id, album):
+        loop = asyncio.get_running_loop()
+        try:
+            cached = self.cache.lookup(album_id)
+            if cached:
+                cover = await loop.run_in_executor(
+                    self.executor,
+                    decode_cached_cover,
+                    cached,
+                    self.cache.raw_path(album_id),
+                )
+                self.cache.update_size(album_id)
+            else:
+                async with self.session.get(cover_url(album)) as response:
+                    response.raise_for_status()
+                    img_data = await response.read()
+                cover = await loop.run_in_executor(
+                    self.executor,
+                    decode_cover,
+                    img_data,
+                    self.cache.path(album_id),
+                    self.cache.raw_path(album_id),
+                )
+                self.cache.store(album_id, len(img_data))
+        except (aiohttp.ClientError, asyncio.TimeoutError, OSError, IndexError) as e:
+            print(f"Failed to load album art for {album_id}: {e}")
+            return None
+        self.decoded[album_id] = cover
+        if self.on_decoded:
+            self.on_decoded(album_id, cover)
+        while len(self.decoded) > hub_constants.DECODED_COVER_CACHE_SIZE:
+            self.decoded.popitem(last=False)
+        return cover
@@ -0,0 +1,71 @@
+import argparse
+import asyncio
+import itertools
+import statistics
+import time
+
+import aiohttp
+import hub_constants
+from profiler import percentile
+
+ENDPOINTS = ["/H", "/L", "/state"]
+
+
+async def worker(session, endpoints, deadline, latencies, errors):
+    while time.perf_counter() < deadline:
+        endpoint = next(endpoints)
+        start = time.perf_counter()
+        try:
+            async with session.get(endpoint) as response:
+                await response.read()
+                if response.status != 200:
+                    errors.append(response.status)
+                    continue
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            errors.append(type(e).__name__)
+            continue
+        latencies.append(time.perf_counter() - start)
+
+
+async def load_test(host, port, concurrency, duration):
+    """hammer the remote (or debug_webserver.py) over keep-alive connections, the
+    same way the hub's pooled session talks to it"""
+    connector = aiohttp.TCPConnector(limit=concurrency)
+    timeout = aiohttp.ClientTimeout(
+        sock_connect=hub_constants.REMOTE_CONNECT_TIMEOUT,
+        sock_read=hub_constants.REMOTE_READ_TIMEOUT,
+    )
+    latencies = []
+    errors = []
+    endpoints = itertools.cycle(ENDPOINTS)
+    async with aiohttp.ClientSession(
+        base_url=f"http://{host}:{port}", connector=connector, timeout=timeout
+    ) as session:
+        start = time.perf_counter()
+        deadline = start + duration
+        await asyncio.gather(
+            *(
+                worker(session, endpoints, deadline, latencies, errors)
+                for _ in range(concurrency)
+            )
+        )
+        elapsed = time.perf_counter() - start
+    latencies.sort()
+    print(f"{len(latencies)} requests in {elapsed:.1f}s, {len(errors)} errors")
+    print(f"{len(latencies) / elapsed:.0f} requests/s")
+    if latencies:
+        print(
+            f"latency p50 {percentile(latencies, 0.5) * 1000:.2f}ms, "
+            f"p99 {percentile(latencies, 0.99) * 1000:.2f}ms, "
+            f"mean {statistics.mean(latencies) * 1000:.2f}ms"
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="load test the on-air remote")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=hub_constants.SERVER_PORT)
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--duration", type=float, default=10, help="seconds")
+    args = parser.parse_args()
+    asyncio.run(load_test(args.host, args.port, args.concurrency, args.duration))
@@ -0,0 +1,135 @@
+import argparse
+import statistics
+import time
+
+import pyray as pr
+
+import hub_constants
+from profiler import percentile
+from screen_layers import ScreenLayers
+
+
+def fill_layer(layer, color, label):
+    def draw():
+        texture = layer.texture.texture
+        pr.draw_rectangle(layer.x, layer.y, texture.width, texture.height, color)
+        pr.draw_text(label, layer.x + 2, layer.y + 2, 10, pr.BLACK)
+
+    layer.update(label, draw)
+
+
+def make_layers():
+    """stand-ins with the hub's layer sizes"""
+    layers = ScreenLayers()
+    fill_layer(layers.add(0, 0, 175, 100), pr.Color(0, 0, 0, 0), "status")
+    fill_layer(layers.add(170, 0, 150, 40), pr.LIGHTGRAY, "on air")
+    fill_layer(layers.add(0, 87, 320, 128), pr.Color(200, 200, 200, 128), "track")
+    fill_layer(layers.add(143, 142, 177, 12), pr.DARKBLUE, "progress")
+    return layers
+
+
+SOURCE = pr.Rectangle(0, 0, hub_constants.SCREEN_WIDTH, -hub_constants.SCREEN_HEIGHT)
+
+
+def draw_screen(layers, overlay):
+    pr.draw_rectangle(
+        0, 0, hub_constants.SCREEN_WIDTH, hub_constants.SCREEN_HEIGHT, pr.SKYBLUE
+    )
+    layers.draw()
+    if overlay:  # the rat, full screen and translucent
+        pr.draw_texture_rec(
+            overlay.texture, SOURCE, pr.Vector2(0, 0), pr.Color(255, 255, 255, 128)
+        )
+
+
+def two_pass_frame(layers, screen_texture, overlay):
+    """the old path: composite into the screen texture, then a rotated blit"""
+    pr.begin_texture_mode(screen_texture)
+    draw_screen(layers, overlay)
+    pr.end_texture_mode()
+    pr.begin_drawing()
+    pr.clear_background(pr.BEIGE)
+    pr.draw_texture_pro(
+        screen_texture.texture,
+        SOURCE,
+        pr.Rectangle(
+            0,
+            hub_constants.SCREEN_WIDTH,
+            hub_constants.SCREEN_WIDTH,
+            hub_constants.SCREEN_HEIGHT,
+        ),
+        pr.Vector2(0, 0),
+        -90,
+        pr.WHITE,
+    )
+    pr.end_drawing()
+
+
+def single_pass_frame(layers, camera, overlay):
+    """the new path: draw the layers straight into the window, rotated by a camera"""
+    pr.begin_drawing()
+    pr.clear_background(pr.BEIGE)
+    pr.begin_mode_2d(camera)
+    draw_screen(layers, overlay)
+    pr.end_mode_2d()
+    pr.end_drawing()
+
+
+def measure(label, frame, frames):
+    for _ in range(min(frames, 30)):  # warm up
+        frame()
+    times = []
+    for _ in range(frames):
+        start = time.perf_counter()
+        frame()
+        times.append(time.perf_counter() - start)
+    times.sort()
+    print(
+        f"{label}: mean {statistics.mean(times) * 1000:.2f}ms, "
+        f"p50 {percentile(times, 0.5) * 1000:.2f}ms, "
+        f"p99 {percentile(times, 0.99) * 1000:.2f}ms"
+    )
+
+
+def bench(frames, overlay):
+    """compare whole frame times, buffer swap included, of the two output paths
+    using the rotated pi window. Run without a frame cap so nothing waits"""
+    pr.init_window(
+        hub_constants.SCREEN_HEIGHT, hub_constants.SCREEN_WIDTH, "render bench"
+    )
+    pr.set_target_fps(0)
+    layers = make_layers()
+    screen_texture = pr.load_render_texture(
+        hub_constants.SCREEN_WIDTH, hub_constants.SCREEN_HEIGHT
+    )
+    rat = None
+    if overlay:
+        rat = pr.load_render_texture(
+            hub_constants.SCREEN_WIDTH, hub_constants.SCREEN_HEIGHT
+        )
+        pr.begin_texture_mode(rat)
+        pr.clear_background(pr.Color(255, 255, 255, 0))
+        pr.draw_circle(160, 120, 80, pr.BROWN)
+        pr.end_texture_mode()
+    camera = pr.Camera2D(
+        pr.Vector2(0, hub_constants.SCREEN_WIDTH), pr.Vector2(0, 0), -90, 1
+    )
+    measure("two pass", lambda: two_pass_frame(layers, screen_texture, rat), frames)
+    measure("single pass", lambda: single_pass_frame(layers, camera, rat), frames)
+    if rat:
+        pr.unload_render_texture(rat)
+    pr.unload_render_texture(screen_texture)
+    layers.unload()
+    pr.close_window()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="frame time of the two pass and single pass output paths"
+    )
+    parser.add_argument("--frames", type=int, default=600)
+    parser.add_argument(
+        "--overlay", action="store_true", help="include a full screen rat overlay"
+    )
+    args = parser.parse_args()
+    bench(args.frames, args.overlay)
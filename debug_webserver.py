@@ -1,40 +1,102 @@
-from http.server import BaseHTTPRequestHandler, HTTPServer
+import argparse
+
+from aiohttp import web, WSMsgType
 import hub_constants
 
-# Simulate the state of the LED
-led_state = "LOW"
 
+class LedRemote:
+    """Local stand-in for the on-air remote. Serves the /H and /L GET endpoints, a
+    /state read endpoint and a websocket at REMOTE_WS_PATH that pushes every LED
+    change to connected hubs. Requests are handled concurrently on one asyncio loop
+    with keep-alive connections, see debug_load_test.py to load it up"""
+
+    def __init__(self):
+        # Simulate the state of the LED
+        self.led_state = "LOW"
+        self.sockets = set()
+
+    async def set_led(self, state):
+        """returns whether the state changed, changes are pushed to every hub"""
+        if state == self.led_state:
+            return False
+        self.led_state = state
+        print(state)
+        for ws in list(self.sockets):
+            try:
+                await ws.send_json({"led": state})
+            except ConnectionResetError:
+                self.sockets.discard(ws)
+        return True
+
+    def respond(self, status, status_code=200):
+        return web.json_response(
+            {"status": status, "led": self.led_state}, status=status_code
+        )
+
+    async def handle_low(self, request):
+        await self.set_led("LOW")
+        return self.respond("LED set to LOW")
+
+    async def handle_high(self, request):
+        await self.set_led("HIGH")
+        return self.respond("LED set to HIGH")
+
+    async def handle_state(self, request):
+        return self.respond("ok")
+
+    async def handle_invalid(self, request):
+        return self.respond("Invalid request", 404)
 
-class RequestHandler(BaseHTTPRequestHandler):
-    def do_GET(self):
-        global led_state
+    async def handle_ws(self, request):
+        ws = web.WebSocketResponse()
+        await ws.prepare(request)
+        self.sockets.add(ws)
+        await ws.send_json({"led": self.led_state})
+        try:
+            async for msg in ws:
+                if msg.type != WSMsgType.TEXT:
+                    continue
+                try:
+                    state = msg.json().get("state")
+                except (ValueError, AttributeError):
+                    state = None  # not json, or not an object
+                if state in ("HIGH", "LOW"):
+                    if not await self.set_led(state):
+                        await ws.send_json({"led": self.led_state})  # still ack it
+                else:
+                    await ws.send_json({"status": "Invalid request"})
+        finally:
+            self.sockets.discard(ws)
+        return ws
 
-        # Parse the path to determine the action
-        if self.path == "/L":
-            led_state = "LOW"
-            self.respond({"status": "LED set to LOW"})
-            print("LOW")
-        elif self.path == "/H":
-            led_state = "HIGH"
-            self.respond({"status": "LED set to HIGH"})
-            print("HIGH")
-        else:
-            self.respond({"status": "Invalid request"}, 404)
-            print("INVALID")
 
-    def respond(self, content, status_code=200):
-        self.send_response(status_code)
-        self.send_header("Content-Type", "application/json")
-        self.end_headers()
-        self.wfile.write(str(content).encode())
+def make_app():
+    remote = LedRemote()
+    app = web.Application()
+    app.add_routes(
+        [
+            web.get("/L", remote.handle_low),
+            web.get("/H", remote.handle_high),
+            web.get("/state", remote.handle_state),
+            web.get(hub_constants.REMOTE_WS_PATH, remote.handle_ws),
+            web.get("/{tail:.*}", remote.handle_invalid),
+        ]
+    )
+    return app
 
 
-def run(server_class=HTTPServer, handler_class=RequestHandler):
-    server_address = ("", hub_constants.SERVER_PORT)
-    httpd = server_class(server_address, handler_class)
-    print(f"Starting server on port {hub_constants.SERVER_PORT}...")
-    httpd.serve_forever()
+def run(port=hub_constants.SERVER_PORT):
+    print(f"Starting server on port {port}...")
+    web.run_app(
+        make_app(),
+        port=port,
+        keepalive_timeout=hub_constants.REMOTE_KEEPALIVE,
+        access_log=None,
+        print=None,
+    )
 
 
 if __name__ == "__main__":
-    run()
+    parser = argparse.ArgumentParser(description="local stand-in for the on-air remote")
+    parser.add_argument("--port", type=int, default=hub_constants.SERVER_PORT)
+    run(parser.parse_args().port)
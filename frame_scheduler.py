@@ -0,0 +1,62 @@
+import asyncio
+import time
+
+import hub_constants
+
+
+class FrameScheduler:
+    """Paces the render loop from asyncio instead of raylib's set_target_fps, which
+    blocks the whole event loop while it waits. The remaining frame budget is spent
+    in asyncio so network callbacks and polls run while the loop would otherwise
+    be idle. Drops to FRAME_RATE_IDLE once nothing has animated or been touched
+    for FRAME_IDLE_AFTER seconds, and poke() brings it straight back"""
+
+    def __init__(
+        self,
+        active_fps=hub_constants.FRAME_RATE_ACTIVE,
+        idle_fps=hub_constants.FRAME_RATE_IDLE,
+        idle_after=hub_constants.FRAME_IDLE_AFTER,
+    ):
+        self.active_fps = active_fps
+        self.idle_fps = idle_fps
+        self.idle_after = idle_after
+        self.target_fps = active_fps
+        self.fps = 0.0  # smoothed actual rate
+        self.async_time = 0.0  # how long other tasks held the loop past the budget
+        self.last_activity = time.monotonic()
+        self.frame_start = time.monotonic()
+        self.wake = asyncio.Event()
+
+    def poke(self):
+        """input or an animation started: render at full rate again, right away"""
+        self.last_activity = time.monotonic()
+        if self.target_fps != self.active_fps:
+            self.target_fps = self.active_fps
+            self.wake.set()  # don't sit out the rest of a long idle frame
+
+    async def next_frame(self, animating=False):
+        """wait out the rest of the frame budget, then start the next frame"""
+        now = time.monotonic()
+        if animating:
+            self.last_activity = now
+        if now - self.last_activity < self.idle_after:
+            self.target_fps = self.active_fps
+        else:
+            self.target_fps = self.idle_fps
+        self.wake.clear()
+        budget = 1 / self.target_fps - (now - self.frame_start)
+        if budget > 0:
+            try:
+                await asyncio.wait_for(self.wake.wait(), budget)
+            except asyncio.TimeoutError:
+                pass
+        else:
+            await asyncio.sleep(0)  # over budget, still let async stuff run
+        waited = time.monotonic() - now
+        self.async_time = max(0.0, waited - max(budget, 0))
+        now = time.monotonic()
+        frame_time = now - self.frame_start
+        self.frame_start = now
+        if frame_time > 0:
+            rate = 1 / frame_time
+            self.fps = rate if not self.fps else self.fps * 0.9 + rate * 0.1
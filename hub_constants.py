@@ -5,8 +5,28 @@ SCREEN_WIDTH = 320
 C_TRUE = ffi.new("bool *", True)
 I2C_BUS = 3
 I2C_ADDRESS = 0x40
-I2C_TIMEOUT = 60  # 1 minute
+I2C_RETRY_MIN = 1  # seconds between connection attempts, doubles per failure
+I2C_RETRY_MAX = 30
+I2C_MAX_READ_FAILURES = 10  # consecutive failed reads before reconnecting
+I2C_PROTOCOL = "byte"  # "byte" for 8 buttons per read, "frame" for batched reads
+I2C_POLL_HZ = 100  # the peripheral only updates i2c every 10ms
 DRAW_RAT = True
+RAT_SPRITE_ATLAS = True  # pre-render the rat's rotation instead of drawing it in 3D
+RAT_SPRITE_CELLS = 48  # rotation frames in the atlas, 7.5 degrees apart
+RAT_SPRITE_SCALE = 0.5  # atlas cell size relative to the screen
+RAT_ROTATION_STEP = 1.5  # degrees per frame
+FRAME_RATE_ACTIVE = 30  # while animating or just after input
+FRAME_RATE_IDLE = 5  # when nothing moves
+FRAME_IDLE_AFTER = 2  # seconds without input or animation before idling
+SINGLE_PASS_OUTPUT = True  # draw straight to the window, no screen texture pass
+PROFILER_FRAMES = 300  # frames of stage timings kept for the profiler overlay
+PROFILER_OVERLAY = False  # show it from startup, F3 toggles it
+PROFILER_DUMP_DIR = "profiles"  # F4 or SIGUSR1 writes a dump here
+PROFILER_DUMP_ON_EXIT = True
+PROFILER_DUMP_KEEP = 10  # older dumps are deleted
+RESOURCE_CACHE_DIR = "resourcecache"
+RAT_MODEL_LOD = 0  # 0 is the full mesh, higher levels are decimated
+MODEL_LOD_GRIDS = (24, 12)  # clustering grid per LOD level above 0
 SPOTIFY_ENABLED = True
 SPOTIFY_SCOPES = [
     "user-library-read",
@@ -14,12 +34,45 @@ SPOTIFY_SCOPES = [
     "user-modify-playback-state",
 ]
 SPOTIFY_CACHE = "./.spotify"
+SPOTIFY_TOKEN_LIFETIME = 3600  # seconds an access token is valid for
+SPOTIFY_TOKEN_REFRESH_MARGIN = 300  # refresh this long before the token expires
+SPOTIFY_TOKEN_RETRY = 30  # seconds between failed refresh attempts
 IMAGE_CACHE_DIR = "imagecache"
+IMAGE_CACHE_MAX_BYTES = 20 * 1024 * 1024  # 20MB, least recently used covers go first
 ALBUM_RESOLUTION = (128, 128)
+MARQUEE_SPEED = 20  # pixels per second for track text too long for the panel
+MARQUEE_PAUSE = 3  # seconds the text rests at the start of every lap
+MARQUEE_GAP = 30  # pixels between the end of the text and its next lap
+ALBUM_ART_TIMEOUT = 10  # seconds
+ALBUM_ATLAS_SLOTS = 8  # covers per atlas texture on the gpu
+DECODED_COVER_CACHE_SIZE = 8  # decoded covers kept in memory
+PREFETCH_QUEUE_DEPTH = 3  # upcoming queue items to prefetch covers for
+ALBUM_ART_RETRY = 30  # seconds before retrying a failed cover download
 PLAYING_COOLDOWN = 5  # 12 times per minute sounds fine
+SPOTIFY_POLL_MID_TRACK = 10  # seconds between polls while a track plays
+SPOTIFY_POLL_MIN = 1  # never poll more often than this
+SPOTIFY_TRACK_END_SLACK = 0.5  # give spotify a moment to switch tracks
+SPOTIFY_POLL_IDLE_MIN = 3  # backoff range while paused or idle
+SPOTIFY_POLL_IDLE_MAX = 30
+SPOTIFY_RATE_LIMIT_DEFAULT = 30  # if a 429 doesn't say how long to wait
+SPOTIFY_WORKER_PROCESS = False  # run the spotify client in a child process
+SPOTIFY_WORKER_START_TIMEOUT = 60  # seconds to wait for the worker to log in
+SPOTIFY_WORKER_RESTART_MAX = 30  # max seconds between worker restarts
 LATENCY_TOLERANCE = 1  # 1 second
 DISPLAY_TEST_PANEL = True
 PAUSE_ON_AIR = True
 RESUME_OFF_AIR = True
 SERVER_IP = "192.168.86.101"
 SERVER_PORT = 80
+REMOTE_CONNECT_TIMEOUT = 2  # seconds
+REMOTE_READ_TIMEOUT = 2  # seconds
+REMOTE_KEEPALIVE = 30  # seconds an idle pooled connection stays open
+REMOTE_POOL_SIZE = 2  # connections kept to the on-air remote
+REMOTE_RETRY_MIN = 0.5  # seconds, doubles per failed sync up to REMOTE_RETRY_MAX
+REMOTE_RETRY_MAX = 30
+REMOTE_HEARTBEAT_MIN = 5  # seconds, doubles while the remote stays in sync
+REMOTE_HEARTBEAT_MAX = 60
+REMOTE_WS_ENABLED = True  # push state over a websocket when the remote has one
+REMOTE_WS_PATH = "/ws"
+REMOTE_WS_HEARTBEAT = 5  # seconds between websocket pings
+REMOTE_WS_RETRY_MAX = 60  # max seconds between channel reconnect attempts
@@ -1,12 +1,53 @@
+import queue
+import struct
+import threading
 import time
 import pigpio
 from gpiozero.pins.mock import MockFactory
 from gpiozero import Button
 import hub_constants
 
+# framed read mode: the peripheral answers one i2c_read_device with
+# version, sequence, 16 button bits, signed encoder count and an xor checksum
+FRAME_VERSION = 1
+FRAME_FORMAT = "<BBHh"
+FRAME_LENGTH = struct.calcsize(FRAME_FORMAT) + 1
+
+
+def checksum(data):
+    result = 0
+    for byte in data:
+        result ^= byte
+    return result
+
+
+def build_frame(sequence, buttons, encoder_count):
+    """what the peripheral sends in framed mode, see parse_frame"""
+    body = struct.pack(
+        FRAME_FORMAT, FRAME_VERSION, sequence & 0xFF, buttons, encoder_count
+    )
+    return body + bytes([checksum(body)])
+
+
+def parse_frame(data):
+    """returns (sequence, buttons, encoder_count), or None for a corrupt frame"""
+    if len(data) != FRAME_LENGTH or checksum(data[:-1]) != data[-1]:
+        return None
+    version, sequence, buttons, encoder_count = struct.unpack(
+        FRAME_FORMAT, bytes(data[:-1])
+    )
+    if version != FRAME_VERSION:
+        return None
+    return sequence, buttons, encoder_count
+
 
 class I2cController:
-    def __init__(self):
+    def __init__(self, pi_factory=pigpio.pi, protocol=hub_constants.I2C_PROTOCOL):
+        """pi_factory makes the pigpio connection, i2c_standin.FakePi can stand in
+        for it without hardware. protocol is "byte" for one byte of 8 buttons per
+        read, or "frame" for the batched multi-byte frame"""
+        self.pi_factory = pi_factory
+        self.framed = protocol == "frame"
         self.handle = None
         self.pin_factory = MockFactory()
         # initialize pins
@@ -23,35 +64,156 @@ class I2cController:
             "push_button5": Button(6, pin_factory=self.pin_factory),
             "push_button6": Button(7, pin_factory=self.pin_factory),
             "push_button7": Button(8, pin_factory=self.pin_factory),
+            # only reported in framed mode
+            "encoder_button": Button(9, pin_factory=self.pin_factory),
         }
 
-        # initialize i2c connection
-        self.pi = pigpio.pi()
-        start_time = time.time()
-        self.handle = None
-        while not self.handle and time.time() - start_time < hub_constants.I2C_TIMEOUT:
+        # the i2c connection is opened (and reopened) by the reader thread, so
+        # startup never waits on the peripheral
+        self.pi = None
+        self.connected = False
+        # the reader thread polls the bus and queues (timestamp, bit, active) edges
+        self.events = queue.Queue()
+        self.encoder_count = 0  # framed mode only
+        self.sequence = None
+        self.dropped_frames = 0
+        self.running = False
+        self.reader = None
+        # called on the reader thread whenever it queued edges or the encoder moved
+        self.on_change = None
+
+    def start(self):
+        self.running = True
+        self.reader = threading.Thread(
+            target=self.poll_loop, name="i2c-reader", daemon=True
+        )
+        self.reader.start()
+
+    def stop(self):
+        self.running = False
+        if self.reader:
+            self.reader.join(timeout=1)
+        self.close()
+        if self.pi is not None:
+            self.pi.stop()
+
+    def open(self):
+        """try to open the peripheral once, returns whether it worked"""
+        try:
+            if self.pi is None or not self.pi.connected:
+                self.pi = self.pi_factory()
+                if not self.pi.connected:
+                    return False
             self.handle = self.pi.i2c_open(
                 hub_constants.I2C_BUS, hub_constants.I2C_ADDRESS
             )
-            time.sleep(1)
-        if not self.handle:
-            raise TimeoutError("i2c connection timed out")
-        self.last_read = 0
+            # make sure something actually answers at the address
+            self.read_state()
+        except pigpio.error:
+            self.close()
+            return False
+        return True
 
-    def update_i2c_pins(self):
-        # the peripheral only updates i2c every 10ms
-        if time.time() - self.last_read > 0.01:
+    def close(self):
+        if self.handle is not None:
+            try:
+                self.pi.i2c_close(self.handle)
+            except pigpio.error:
+                pass
+        self.handle = None
+
+    def connect(self):
+        """block the reader thread until the peripheral opens, backing off between
+        attempts. Returns False if the controller was stopped meanwhile"""
+        delay = hub_constants.I2C_RETRY_MIN
+        while self.running:
+            if self.open():
+                print("i2c peripheral connected")
+                self.connected = True
+                return True
+            time.sleep(delay)
+            delay = min(delay * 2, hub_constants.I2C_RETRY_MAX)
+        return False
+
+    def read_state(self):
+        """one bus transaction. Returns the button bits, or None if the peripheral
+        has nothing new. Raises pigpio.error when the read fails"""
+        if not self.framed:
+            return self.pi.i2c_read_byte(self.handle)
+        count, data = self.pi.i2c_read_device(self.handle, FRAME_LENGTH)
+        if count < 0:
+            raise pigpio.error(f"i2c_read_device failed ({count})")
+        frame = parse_frame(data[:count])
+        if frame is None:
+            raise pigpio.error("corrupt i2c frame")
+        sequence, buttons, self.encoder_count = frame
+        if sequence == self.sequence:
+            return None  # the peripheral hasn't updated since the last read
+        if self.sequence is not None:
+            self.dropped_frames += (sequence - self.sequence - 1) % 256
+        self.sequence = sequence
+        return buttons
+
+    def poll_loop(self):
+        """reads the peripheral at I2C_POLL_HZ no matter the frame rate, queueing only
+        the bits that changed since the last read. Reconnects after repeated failures"""
+        period = 1 / hub_constants.I2C_POLL_HZ
+        all_bits = 0xFFFF if self.framed else 0xFF
+        previous = None
+        failures = 0
+        next_read = time.monotonic()
+        while self.running:
+            if not self.connected:
+                if not self.connect():
+                    break
+                previous = None  # resync every bit
+                self.sequence = None
+                failures = 0
+                next_read = time.monotonic()
+            encoder_count = self.encoder_count
             try:
-                byte = self.pi.i2c_read_byte(self.handle)
-                bits = [int(i) for i in f"{byte:08b}"[::-1]]
-                if len(bits) == 0:
-                    return
-                for i, bit in enumerate(bits):
-                    if bit:
-                        self.pin_factory.pin(i + 1).drive_low()
-                    else:
-                        self.pin_factory.pin(i + 1).drive_high()
+                bits = self.read_state()
+                failures = 0
             except pigpio.error:
-                print("i2c read failed! Skipping for this frame..")
+                if failures == 0:
+                    print("i2c read failed! Retrying..")
+                failures += 1
+                bits = previous
+                if failures >= hub_constants.I2C_MAX_READ_FAILURES:
+                    print("i2c peripheral lost, reconnecting..")
+                    self.connected = False
+                    self.close()
+                    bits = 0  # release anything that was held down
+            changed = 0
+            if bits is not None:
+                timestamp = time.monotonic()
+                # every bit counts as changed on the first read
+                changed = all_bits if previous is None else bits ^ previous
+                remaining = changed
+                bit = 0
+                while remaining:
+                    if remaining & 1:
+                        self.events.put((timestamp, bit, bool(bits >> bit & 1)))
+                    remaining >>= 1
+                    bit += 1
+                previous = bits
+            if self.on_change and (changed or self.encoder_count != encoder_count):
+                self.on_change()
+            next_read += period
+            delay = next_read - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            else:
+                next_read = time.monotonic()  # fell behind, don't try to catch up
+
+    def update_i2c_pins(self):
+        """drains the reader's edges on the main loop and drives the matching mock pins"""
+        while True:
+            try:
+                _, bit, active = self.events.get_nowait()
+            except queue.Empty:
                 return
-            return
+            if active:
+                self.pin_factory.pin(bit + 1).drive_low()
+            else:
+                self.pin_factory.pin(bit + 1).drive_high()
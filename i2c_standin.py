@@ -0,0 +1,103 @@
+import threading
+import time
+
+import pigpio
+
+import hub_constants
+from i2c_controller import I2cController, build_frame
+
+
+class FakePeripheral:
+    """Simulated RP2040 input peripheral: 16 button bits and an encoder count.
+    Every change bumps the frame sequence number like the real firmware"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.buttons = 0
+        self.encoder_count = 0
+        self.sequence = 0
+        self.present = True  # set False to simulate an unplugged peripheral
+
+    def press(self, bit):
+        with self.lock:
+            self.buttons |= 1 << bit
+            self.sequence += 1
+
+    def release(self, bit):
+        with self.lock:
+            self.buttons &= ~(1 << bit)
+            self.sequence += 1
+
+    def turn(self, steps):
+        with self.lock:
+            self.encoder_count = max(-32768, min(32767, self.encoder_count + steps))
+            self.sequence += 1
+
+    def frame(self):
+        with self.lock:
+            return build_frame(self.sequence, self.buttons, self.encoder_count)
+
+
+class FakePi:
+    """Stands in for pigpio.pi with just the calls I2cController makes, backed by
+    a FakePeripheral. Pass it as I2cController's pi_factory to run without hardware"""
+
+    peripheral = FakePeripheral()
+
+    def __init__(self):
+        self.connected = True
+        self.handles = set()
+
+    def check(self, handle):
+        if handle not in self.handles or not self.peripheral.present:
+            raise pigpio.error("remote I/O error")
+
+    def i2c_open(self, bus, address, flags=0):
+        if (
+            bus != hub_constants.I2C_BUS
+            or address != hub_constants.I2C_ADDRESS
+            or not self.peripheral.present
+        ):
+            raise pigpio.error("no device at address")
+        handle = len(self.handles)
+        self.handles.add(handle)
+        return handle
+
+    def i2c_close(self, handle):
+        self.handles.discard(handle)
+
+    def i2c_read_byte(self, handle):
+        self.check(handle)
+        return self.peripheral.buttons & 0xFF
+
+    def i2c_read_device(self, handle, count):
+        self.check(handle)
+        frame = self.peripheral.frame()[:count]
+        return len(frame), bytearray(frame)
+
+    def stop(self):
+        self.connected = False
+
+
+if __name__ == "__main__":
+    # exercise the framed protocol end to end without hardware
+    controller = I2cController(pi_factory=FakePi, protocol="frame")
+    controller.start()
+    while not controller.connected:
+        time.sleep(0.01)
+    peripheral = FakePi.peripheral
+    peripheral.press(1)
+    peripheral.turn(3)
+    peripheral.press(8)
+    time.sleep(0.05)
+    peripheral.present = False  # unplug, the controller should release everything
+    time.sleep(0.2)
+    peripheral.present = True
+    time.sleep(hub_constants.I2C_RETRY_MIN + 0.2)
+    controller.stop()
+    while not controller.events.empty():
+        print(controller.events.get())
+    print(
+        f"encoder {controller.encoder_count}, dropped frames "
+        f"{controller.dropped_frames}, connected {controller.connected}"
+    )
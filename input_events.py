@@ -0,0 +1,42 @@
+import asyncio
+import threading
+
+
+class InputEventBus:
+    """Marshals gpiozero device edges onto the asyncio loop. gpiozero fires
+    when_* callbacks on its own threads, where asyncio.create_task isn't safe, so
+    the bus only records the edge there and hands it to the loop with
+    call_soon_threadsafe. An edge that fires again before the loop got to it is
+    coalesced into one dispatch, so handlers should read the device's current
+    state rather than count calls."""
+
+    def __init__(self, loop):
+        self.loop = loop
+        self.handlers = {}  # (id(device), event): [handler]
+        self.pending = set()
+        self.lock = threading.Lock()
+
+    def on(self, device, event, handler):
+        """call handler on the loop whenever device fires when_<event>, e.g.
+        "activated", "deactivated" or "rotated". Coroutine handlers become tasks"""
+        key = (id(device), event)
+        if key not in self.handlers:
+            self.handlers[key] = []
+            setattr(device, f"when_{event}", lambda: self.post(key))
+        self.handlers[key].append(handler)
+
+    def post(self, key):
+        """safe to call from any thread"""
+        with self.lock:
+            if key in self.pending:
+                return  # already queued, coalesce the burst
+            self.pending.add(key)
+        self.loop.call_soon_threadsafe(self.dispatch, key)
+
+    def dispatch(self, key):
+        with self.lock:
+            self.pending.discard(key)
+        for handler in self.handlers.get(key, []):
+            result = handler()
+            if asyncio.iscoroutine(result):
+                self.loop.create_task(result)
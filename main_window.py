@@ -1,14 +1,22 @@
 import asyncio
 import io
-import sys
+import signal
 import aiohttp
 import pyray as pr
 from gpiozero import Button, RotaryEncoder
 import hub_constants
 
+from frame_scheduler import FrameScheduler
 from i2c_controller import I2cController
+from input_events import InputEventBus
+import mesh_cache
+from on_air_sync import OnAirSync
+from profiler import FrameProfiler
+from rat_sprites import RatSpriteAtlas
+from screen_layers import ScreenLayers
 import pin_control_panel
-from spotipy_controller import SpotifyController
+from spotipy_controller import SpotifyController, SpotifyTrack
+from spotify_worker import SpotifyProcessClient
 
 
 def is_raspberrypi():
@@ -37,14 +45,33 @@ class PiDeskHub:
                 hub_constants.SCREEN_WIDTH,
                 "pi-desk-hub main window",
             )
-        pr.set_target_fps(30)
+        # frames are paced by the scheduler, so raylib never blocks the loop
+        self.frames = None
 
-        self.screen_texture = pr.load_render_texture(
-            hub_constants.SCREEN_WIDTH, hub_constants.SCREEN_HEIGHT
-        )
-        self.rat_render = pr.load_render_texture(
-            hub_constants.SCREEN_WIDTH, hub_constants.SCREEN_HEIGHT
-        )
+        # single pass output draws the layers straight into the window through a 2D
+        # camera that does the pi's rotation, the screen texture is only needed
+        # when the composite has to be drawn as a whole
+        self.screen_texture = None
+        if not hub_constants.SINGLE_PASS_OUTPUT:
+            self.screen_texture = pr.load_render_texture(
+                hub_constants.SCREEN_WIDTH, hub_constants.SCREEN_HEIGHT
+            )
+        if self.debug:
+            self.output_camera = pr.Camera2D(pr.Vector2(0, 0), pr.Vector2(0, 0), 0, 1)
+        else:  # same transform as the screen texture blit below
+            self.output_camera = pr.Camera2D(
+                pr.Vector2(0, hub_constants.SCREEN_WIDTH), pr.Vector2(0, 0), -90, 1
+            )
+        self.rat_render = None
+        # each element is cached in its own layer and the screen texture is only
+        # recomposited when one of them (or something animated) changed
+        self.layers = ScreenLayers()
+        self.status_layer = self.layers.add(0, 0, 175, 100)  # the badge covers x>175
+        self.on_air_layer = self.layers.add(170, 0, 150, 40)
+        self.track_layer = self.layers.add(*SpotifyTrack.panel_bounds())
+        self.progress_layer = self.layers.add(*SpotifyTrack.progress_bounds())
+        self.screen_animated = False
+        self.profiler = FrameProfiler()
         self.source = pr.Rectangle(
             0.0, 0.0, hub_constants.SCREEN_WIDTH, -hub_constants.SCREEN_HEIGHT
         )
@@ -63,12 +90,32 @@ class PiDeskHub:
         )  # Camera up vector (rotation towards target)
         self.camera.fovy = 45.0  # Camera field-of-view Y
         self.camera.projection = pr.CAMERA_PERSPECTIVE  # Camera mode type
-        self.rat_model = pr.load_model("./resources/rat.obj")
+        self.rat_model_path = "./resources/rat.obj"
+        self.rat_model = mesh_cache.load_model(
+            self.rat_model_path, hub_constants.RAT_MODEL_LOD
+        )
         self.rat_position = pr.Vector3(0, 1, 0)
+        self.rat_scale = pr.Vector3(0.1, 0.1, 0.1)
         self.rat_rotation = -90
         self.rat_alpha = 0
+        self.rat_sprites = None
+        if hub_constants.RAT_SPRITE_ATLAS:
+            self.rat_sprites = RatSpriteAtlas(
+                self.rat_model,
+                self.rat_model_path,
+                self.camera,
+                self.rat_position,
+                self.rat_scale,
+                self.rat_rotation,
+            )
+            self.rat_sprites.load()
+        else:
+            self.rat_render = pr.load_render_texture(
+                hub_constants.SCREEN_WIDTH, hub_constants.SCREEN_HEIGHT
+            )
         # handle mock pins and i2c connection
-        self.remote_connected = False
+        self.http_session = None
+        self.on_air_sync = None
         self.connection_icon = pr.load_texture("./resources/connection_icon.png")
         if self.debug:
             self.test_window = pin_control_panel.PinControlPanel(self)
@@ -76,11 +123,9 @@ class PiDeskHub:
             self.push_button1 = Button(2)
             self.i2c_controller = None
         else:
-            try:
-                self.i2c_controller = I2cController()
-            except TimeoutError as e:
-                print(e)
-                sys.exit()
+            # connects in the background, rendering doesn't wait for the peripheral
+            self.i2c_controller = I2cController()
+            self.i2c_controller.start()
             self.on_air = self.i2c_controller.devices["on_air_button"]
             self.push_button1 = self.i2c_controller.devices["push_button1"]
 
@@ -91,101 +136,275 @@ class PiDeskHub:
         # 10: Encoder B
         # 27: Encoder A
         self.encoder = RotaryEncoder(27, 10)
-        self.encoder_button = Button(11)
+        if self.i2c_controller and self.i2c_controller.framed:
+            # the rp2040 reports the encoder in its framed reads
+            self.encoder_button = self.i2c_controller.devices["encoder_button"]
+        else:
+            self.encoder_button = Button(11)
         self.encoder_val_prev = -1
+        self.i2c_encoder_value = None  # last value derived from the framed count
+        self.encoder_held = False
+        self.on_air_active = False
+        self.input_events = None
+        self.active_devices = set()  # labels of held i2c buttons, for the status text
 
     def __del__(self):
-        pr.unload_render_texture(self.screen_texture)
-        pr.unload_render_texture(self.rat_render)
+        if self.screen_texture:
+            pr.unload_render_texture(self.screen_texture)
+        self.layers.unload()
+        if self.rat_render:
+            pr.unload_render_texture(self.rat_render)
+        if self.rat_sprites:
+            self.rat_sprites.unload()
         pr.unload_model(self.rat_model)
         pr.close_window()
 
     async def start_game_loop(self):
+        self.http_session = self.create_http_session()
+        self.on_air_sync = OnAirSync(self.http_session, lambda: self.on_air_active)
+        self.frames = FrameScheduler()
+        self.bind_inputs()
         await self.initialize_spotipy()
         if self.spotipy:
             self.spotipy.is_updating = True
             if hub_constants.PAUSE_ON_AIR:
-                self.on_air.when_activated = self.sync_on_air
+                self.input_events.on(self.on_air, "activated", self.sync_on_air)
                 if hub_constants.RESUME_OFF_AIR:
-                    self.on_air.when_deactivated = self.sync_on_air
+                    self.input_events.on(self.on_air, "deactivated", self.sync_on_air)
             asyncio.create_task(self.spotipy.update_loop())
-        asyncio.create_task(self.on_air_remote_loop())
+        on_air_task = asyncio.create_task(self.on_air_sync.run())
+        loop = asyncio.get_running_loop()
+        try:  # `kill -USR1` dumps the profile on the pi, where there's no keyboard
+            loop.add_signal_handler(signal.SIGUSR1, self.profiler.dump)
+        except (NotImplementedError, AttributeError):
+            pass
+        profile = self.profiler.scope
         while not pr.window_should_close():  # Detect window close button or ESC key
             # Update
-            await asyncio.sleep(0)  # let async stuff run
-            if self.encoder_button.is_active:
-                pr.draw_text("Encoder button active!", 45, 200, 4, pr.BLACK)
-                self.encoder_val_prev = self.encoder.value
-            self.encoder.value = self.encoder_val_prev
-            self.rat_alpha = (
-                int(255 * (self.encoder.value + 1) / 2) if hub_constants.DRAW_RAT else 0
-            )
-            self.render_rat()
-
-            # Draw to texture
-            pr.begin_texture_mode(self.screen_texture)
-            pr.clear_background(pr.SKYBLUE)
-            self.handle_i2c()
-            self.draw_on_air()
-            if self.spotipy:
-                self.spotipy.display_track()
-            if self.rat_alpha:
-                pr.draw_texture_rec(
-                    self.rat_render.texture,
-                    self.source,
-                    pr.Vector2(0, 0),
-                    pr.Color(255, 255, 255, self.rat_alpha),
+            await self.frames.next_frame(self.screen_animated)  # let async stuff run
+            self.profiler.end_frame()
+            self.profiler.record("async", self.frames.async_time)
+            with profile("input"):
+                self.handle_keys()
+                if self.encoder_held:
+                    pr.draw_text("Encoder button active!", 45, 200, 4, pr.BLACK)
+                    self.encoder_val_prev = self.encoder.value
+                self.encoder.value = self.encoder_val_prev
+                self.rat_alpha = (
+                    int(255 * (self.encoder.value + 1) / 2)
+                    if hub_constants.DRAW_RAT
+                    else 0
                 )
+            with profile("rat"):
+                self.render_rat()
+            with profile("i2c"):
+                self.handle_i2c()
+            self.update_layers()
 
-            pr.end_texture_mode()
-
-            # Draw texture to screen
-            pr.begin_drawing()
-            pr.clear_background(pr.BEIGE)
-            if self.debug:  # draw horizontal
-                pr.draw_texture_rec(
-                    self.screen_texture.texture, self.source, pr.Vector2(0, 0), pr.WHITE
-                )
-            else:  # rotate 90 degrees on pi
-                pr.draw_texture_pro(
-                    self.screen_texture.texture,
-                    self.source,
-                    self.destination,
-                    pr.Vector2(0, 0),
-                    -90,
-                    pr.WHITE,
-                )
-            if self.debug:
-                self.test_window.mainloop(self.encoder.value)
-                self.encoder.value = self.test_window.encoder_value
-            pr.end_drawing()
+            track = self.spotipy.playing if self.spotipy else None
+            animated = (
+                bool(self.rat_alpha)
+                or self.time_debug_visible()
+                or (track is not None and track.text_animating())
+                or self.profiler.visible
+            )
+            with profile("screen"):
+                if self.screen_texture:
+                    # Draw to texture, only when something on it changed
+                    if self.layers.dirty or animated or self.screen_animated:
+                        pr.begin_texture_mode(self.screen_texture)
+                        self.draw_screen()
+                        pr.end_texture_mode()
+                    # Draw texture to screen
+                    pr.begin_drawing()
+                    pr.clear_background(pr.BEIGE)
+                    self.draw_screen_texture()
+                else:
+                    pr.begin_drawing()
+                    pr.clear_background(pr.BEIGE)
+                    pr.begin_mode_2d(self.output_camera)
+                    self.draw_screen()
+                    pr.end_mode_2d()
+            # one more pass after an animation stops to clear its last frame
+            self.screen_animated = animated
+            with profile("present"):
+                if self.debug:
+                    self.test_window.mainloop(self.encoder.value)
+                    self.encoder.value = self.test_window.encoder_value
+                pr.end_drawing()
+        if hub_constants.PROFILER_DUMP_ON_EXIT and self.profiler.stages:
+            self.profiler.dump()
         if self.spotipy:
-            loop = asyncio.get_event_loop()
-            if loop.is_running():
-                # If the loop is running, create a task for the cleanup
-                loop.create_task(self.spotipy.cleanup())
+            # finish before returning, asyncio.run cancels anything still pending
+            await self.spotipy.cleanup()
+        on_air_task.cancel()
+        if self.i2c_controller:
+            self.i2c_controller.stop()
+        await self.http_session.close()
+
+    def bind_inputs(self):
+        """route device edges through the event bus so gpiozero's threads never touch
+        the loop, and the frame loop reads plain attributes instead of devices"""
+        self.input_events = InputEventBus(asyncio.get_running_loop())
+        self.on_air_active = bool(self.on_air.is_active)
+        self.encoder_held = bool(self.encoder_button.is_active)
+        self.input_events.on(self.on_air, "activated", self.update_on_air)
+        self.input_events.on(self.on_air, "deactivated", self.update_on_air)
+        self.input_events.on(self.encoder_button, "activated", self.update_encoder)
+        self.input_events.on(self.encoder_button, "deactivated", self.update_encoder)
+        self.input_events.on(self.push_button1, "activated", self.frames.poke)
+        self.input_events.on(self.encoder, "rotated", self.frames.poke)
+        if self.i2c_controller:
+            loop = asyncio.get_running_loop()
+            # don't leave i2c edges waiting for the next (possibly idle) frame
+            self.i2c_controller.on_change = lambda: loop.call_soon_threadsafe(
+                self.drain_i2c
+            )
+            for label, device in self.i2c_controller.devices.items():
+                if label != "on_air_button":
+                    self.track_device(label, device)
+
+    def track_device(self, label, device):
+        def update():
+            if device.is_active:
+                self.active_devices.add(label)
             else:
-                # If the loop is not running, run the cleanup task directly
-                loop.run_until_complete(self.spotipy.cleanup())
+                self.active_devices.discard(label)
+
+        update()
+        self.input_events.on(device, "activated", update)
+        self.input_events.on(device, "deactivated", update)
+
+    def update_on_air(self):
+        self.on_air_active = bool(self.on_air.is_active)
+        self.frames.poke()
+
+    def update_encoder(self):
+        self.encoder_held = bool(self.encoder_button.is_active)
+        self.frames.poke()
+
+    def poke_on_mouse(self):
+        # the debug window's pin panel is driven by the mouse
+        delta = pr.get_mouse_delta()
+        wheel = pr.get_mouse_wheel_move()
+        if delta.x or delta.y or wheel or pr.is_mouse_button_down(0):
+            self.frames.poke()
+
+    @property
+    def remote_connected(self):
+        return self.on_air_sync is not None and self.on_air_sync.connected
 
     def sync_on_air(self):
-        endpoint = "/H" if self.on_air.is_active else "/L"
-        asyncio.create_task(self.send_request(endpoint))
+        self.on_air_sync.set_state(self.on_air_active)
+
+    def draw_screen(self):
+        """composite the layers and anything animated, in screen coordinates"""
+        pr.draw_rectangle(
+            0, 0, hub_constants.SCREEN_WIDTH, hub_constants.SCREEN_HEIGHT, pr.SKYBLUE
+        )
+        self.layers.draw()
+        if self.spotipy and self.spotipy.playing:
+            self.spotipy.playing.draw_scrolling_text()
+        if self.time_debug_visible():
+            self.spotipy.playing.draw_time_debug()
+        if self.rat_alpha:
+            self.draw_rat()
+        if self.profiler.visible:
+            self.profiler.draw()
+
+    def draw_screen_texture(self):
+        if self.debug:  # draw horizontal
+            pr.draw_texture_rec(
+                self.screen_texture.texture, self.source, pr.Vector2(0, 0), pr.WHITE
+            )
+        else:  # rotate 90 degrees on pi
+            pr.draw_texture_pro(
+                self.screen_texture.texture,
+                self.source,
+                self.destination,
+                pr.Vector2(0, 0),
+                -90,
+                pr.WHITE,
+            )
+
+    def update_layers(self):
+        with self.profiler.scope("layers"):
+            self.status_layer.update(self.status_key(), self.draw_status)
+            self.on_air_layer.update(
+                (self.on_air_active, self.remote_connected), self.draw_on_air
+            )
+        if self.spotipy:
+            with self.profiler.scope("spotify"):
+                self.spotipy.display_track(self.track_layer, self.progress_layer)
+
+    def handle_keys(self):
+        if self.debug:
+            self.poke_on_mouse()
+        if pr.is_key_pressed(pr.KEY_F3):
+            self.profiler.visible = not self.profiler.visible
+            self.frames.poke()
+        if pr.is_key_pressed(pr.KEY_F4):
+            self.profiler.dump()
+
+    def time_debug_visible(self):
+        return (
+            self.debug
+            and hub_constants.DISPLAY_TEST_PANEL
+            and self.spotipy is not None
+            and self.spotipy.playing is not None
+        )
+
+    def drain_i2c(self):
+        self.i2c_controller.update_i2c_pins()
+        self.frames.poke()
 
     def handle_i2c(self):
         if self.i2c_controller:
             self.i2c_controller.update_i2c_pins()
-            y = 10
-            # TODO remove this debug display
-            for label, device in self.i2c_controller.devices.items():
-                if label != "on_air_button" and device.is_active:
-                    pr.draw_text(f"{label} active", 45, y, 3, pr.DARKGRAY)
-                    y += 10
-        elif self.debug:
+            if self.i2c_controller.framed:
+                steps = self.i2c_controller.encoder_count / self.encoder.max_steps
+                value = max(-1, min(1, steps))
+                # encoder.value is reset every frame, so compare with the last count
+                if value != self.i2c_encoder_value:
+                    self.i2c_encoder_value = value
+                    self.frames.poke()
+                self.encoder.value = value
+
+    def status_key(self):
+        """what the status layer shows: active devices and whether the peripheral
+        is missing"""
+        if self.i2c_controller:
+            active = tuple(
+                label
+                for label in self.i2c_controller.devices
+                if label in self.active_devices
+            )
+            return active, not self.i2c_controller.connected
+        return (), self.debug
+
+    def draw_status(self):
+        active, missing = self.status_key()
+        y = 10
+        # TODO remove this debug display
+        for label in active:
+            pr.draw_text(f"{label} active", 45, y, 3, pr.DARKGRAY)
+            y += 10
+        if missing:
             pr.draw_text("Input peripheral not found", 40, 2, 12, pr.RED)
 
+    def draw_rat(self):
+        tint = pr.Color(255, 255, 255, self.rat_alpha)
+        if self.rat_sprites:
+            self.rat_sprites.draw(self.rat_rotation, tint)
+        else:
+            pr.draw_texture_rec(
+                self.rat_render.texture, self.source, pr.Vector2(0, 0), tint
+            )
+
     def render_rat(self):
-        if self.rat_alpha:
+        if self.rat_alpha and self.rat_sprites:
+            self.rat_rotation += hub_constants.RAT_ROTATION_STEP
+        elif self.rat_alpha:
             pr.begin_texture_mode(self.rat_render)
             pr.clear_background(pr.Color(255, 255, 255, 0))
             pr.begin_mode_3d(self.camera)
@@ -194,38 +413,32 @@ class PiDeskHub:
                 self.rat_position,
                 pr.Vector3(0.0, 1.0, 0.0),
                 self.rat_rotation,
-                pr.Vector3(0.1, 0.1, 0.1),
+                self.rat_scale,
                 pr.Color(255, 255, 255, 255),
             )
-            self.rat_rotation += 1.5
+            self.rat_rotation += hub_constants.RAT_ROTATION_STEP
             pr.end_mode_3d()
             pr.end_texture_mode()
 
-    async def on_air_remote_loop(self):
-        while not pr.window_should_close():
-            if not self.remote_connected:
-                self.sync_on_air()
-            await asyncio.sleep(10)
-
-    async def send_request(self, endpoint):
-        try:
-            url = f"http://{hub_constants.SERVER_IP}:{hub_constants.SERVER_PORT}{endpoint}"
-            async with aiohttp.ClientSession() as session:
-                async with session.get(url) as response:
-                    if response.status == 200:
-                        self.remote_connected = True
-                    else:
-                        print(
-                            f"Failed to get a valid response. Status code: {response.status}"
-                        )
-                        self.remote_connected = False
-        except ConnectionRefusedError:
-            self.remote_connected = False
-        except aiohttp.ClientConnectorError:
-            self.remote_connected = False
+    def create_http_session(self):
+        """one long lived session for the on-air remote, so syncs reuse a pooled
+        keep-alive connection instead of setting up a new socket every time"""
+        connector = aiohttp.TCPConnector(
+            limit_per_host=hub_constants.REMOTE_POOL_SIZE,
+            keepalive_timeout=hub_constants.REMOTE_KEEPALIVE,
+        )
+        timeout = aiohttp.ClientTimeout(
+            sock_connect=hub_constants.REMOTE_CONNECT_TIMEOUT,
+            sock_read=hub_constants.REMOTE_READ_TIMEOUT,
+        )
+        return aiohttp.ClientSession(
+            base_url=f"http://{hub_constants.SERVER_IP}:{hub_constants.SERVER_PORT}",
+            connector=connector,
+            timeout=timeout,
+        )
 
     def draw_on_air(self):
-        if self.on_air.is_active:
+        if self.on_air_active:
             color = pr.RED
         else:
             color = pr.GRAY
@@ -240,10 +453,15 @@ class PiDeskHub:
     async def initialize_spotipy(self):
         if hub_constants.SPOTIFY_ENABLED:
             try:
-                self.spotipy = SpotifyController(self)
+                if hub_constants.SPOTIFY_WORKER_PROCESS:
+                    self.spotipy = SpotifyProcessClient(self)
+                else:
+                    self.spotipy = SpotifyController(self)
                 await self.spotipy.async_init()
                 if self.spotipy:
-                    self.push_button1.when_activated = self.spotipy.toggle_playback
+                    self.input_events.on(
+                        self.push_button1, "activated", self.spotipy.toggle_playback
+                    )
             except PermissionError as e:
                 print(e)
                 self.spotipy = None
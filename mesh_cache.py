@@ -0,0 +1,256 @@
+import glob
+import hashlib
+import math
+import mmap
+import os
+import struct
+from array import array
+
+import pyray as pr
+from raylib import ffi
+
+import hub_constants
+from file_utils import atomic_write
+
+# binary mesh format: header, then per mesh a (vertex count, flags) header followed
+# by float32 positions, texcoords and normals for non-indexed triangles
+MAGIC = b"PDHM"
+VERSION = 1
+HEADER = struct.Struct("<4sHHqq20sH")  # magic, version, meshes, mtime, size, sha1, len
+MESH_HEADER = struct.Struct("<II")  # vertex count, flags
+HAS_TEXCOORDS = 1
+HAS_NORMALS = 2
+
+
+def source_files(model_path):
+    """the model and its sibling files (mtl, textures) sharing its name"""
+    stem = os.path.splitext(model_path)[0]
+    return sorted(glob.glob(f"{stem}.*"))
+
+
+def model_hash(model_path):
+    digest = hashlib.sha1()
+    for path in source_files(model_path):
+        with open(path, "rb") as f:
+            digest.update(f.read())
+    return digest.digest()
+
+
+def source_stamp(model_path):
+    stats = [os.stat(path) for path in source_files(model_path)]
+    return max(s.st_mtime_ns for s in stats), sum(s.st_size for s in stats)
+
+
+def cache_path(model_path, lod):
+    name = os.path.splitext(os.path.basename(model_path))[0]
+    return os.path.join(hub_constants.RESOURCE_CACHE_DIR, f"{name}.lod{lod}.bin")
+
+
+def albedo_texture(model_path):
+    """the map_Kd texture of the obj's material library, relative to the obj"""
+    with open(model_path, "r", encoding="utf-8") as f:
+        mtllib = next(
+            (line.split(None, 1)[1] for line in f if line.startswith("mtllib")), None
+        )
+    if not mtllib:
+        return ""
+    mtl_path = os.path.join(os.path.dirname(model_path), mtllib.strip())
+    with open(mtl_path, "r", encoding="utf-8") as f:
+        for line in f:
+            if line.startswith("map_Kd"):
+                return line.split(None, 1)[1].strip()
+    return ""
+
+
+class MeshData:
+    """flat float arrays for one non-indexed triangle mesh"""
+
+    def __init__(self, vertices, texcoords=None, normals=None):
+        self.vertices = vertices
+        self.texcoords = texcoords
+        self.normals = normals
+
+    @property
+    def vertex_count(self):
+        return len(self.vertices) // 3
+
+    @classmethod
+    def from_raylib(cls, mesh):
+        count = mesh.vertexCount
+
+        def read(pointer, width):
+            if pointer == ffi.NULL:
+                return None
+            values = array("f")
+            values.frombytes(ffi.buffer(pointer, count * width * 4))
+            if mesh.indices != ffi.NULL:  # expand to non-indexed triangles
+                indices = ffi.unpack(mesh.indices, mesh.triangleCount * 3)
+                values = array(
+                    "f", [values[i * width + c] for i in indices for c in range(width)]
+                )
+            return values
+
+        return cls(
+            read(mesh.vertices, 3), read(mesh.texcoords, 2), read(mesh.normals, 3)
+        )
+
+    def decimate(self, grid):
+        """vertex clustering: snap vertices to a grid of `grid` cells along the
+        longest axis, merge each cell into one vertex and drop collapsed triangles"""
+        v = self.vertices
+        mins = [min(v[axis::3]) for axis in range(3)]
+        extent = max(max(v[axis::3]) - mins[axis] for axis in range(3))
+        cell = extent / grid or 1.0
+        keys = [
+            tuple(
+                math.floor((v[i * 3 + axis] - mins[axis]) / cell) for axis in range(3)
+            )
+            for i in range(self.vertex_count)
+        ]
+        # each cluster is represented by the mean position of its vertices
+        sums = {}
+        for i, key in enumerate(keys):
+            total = sums.setdefault(key, [0.0, 0.0, 0.0, 0])
+            for axis in range(3):
+                total[axis] += v[i * 3 + axis]
+            total[3] += 1
+        vertices, texcoords, normals = array("f"), array("f"), array("f")
+        for tri in range(0, self.vertex_count, 3):
+            corners = keys[tri : tri + 3]
+            if len(set(corners)) < 3:
+                continue  # collapsed into a line or point
+            for i, key in zip(range(tri, tri + 3), corners):
+                total = sums[key]
+                vertices.extend(total[axis] / total[3] for axis in range(3))
+                if self.texcoords:
+                    texcoords.extend(self.texcoords[i * 2 : i * 2 + 2])
+                if self.normals:
+                    normals.extend(self.normals[i * 3 : i * 3 + 3])
+        return MeshData(
+            vertices,
+            texcoords if self.texcoords else None,
+            normals if self.normals else None,
+        )
+
+    def to_bytes(self):
+        flags = (HAS_TEXCOORDS if self.texcoords else 0) | (
+            HAS_NORMALS if self.normals else 0
+        )
+        parts = [MESH_HEADER.pack(self.vertex_count, flags), self.vertices.tobytes()]
+        if self.texcoords:
+            parts.append(self.texcoords.tobytes())
+        if self.normals:
+            parts.append(self.normals.tobytes())
+        return b"".join(parts)
+
+
+def write_cache(model_path, meshes, lod):
+    mtime, size = source_stamp(model_path)
+    texture = albedo_texture(model_path).encode()
+    header = HEADER.pack(
+        MAGIC, VERSION, len(meshes), mtime, size, model_hash(model_path), len(texture)
+    )
+    body = b"".join(mesh.to_bytes() for mesh in meshes)
+    os.makedirs(hub_constants.RESOURCE_CACHE_DIR, exist_ok=True)
+    atomic_write(cache_path(model_path, lod), header + texture + body)
+
+
+def build_cache(model_path, model):
+    """write the binary cache for a model freshly loaded from its obj, plus a
+    decimated mesh for every grid in MODEL_LOD_GRIDS. Returns whether it wrote
+    anything"""
+    if model.meshCount != 1:
+        return False  # multi mesh models keep loading from the obj
+    meshes = [MeshData.from_raylib(model.meshes[i]) for i in range(model.meshCount)]
+    write_cache(model_path, meshes, 0)
+    for lod, grid in enumerate(hub_constants.MODEL_LOD_GRIDS, start=1):
+        write_cache(model_path, [mesh.decimate(grid) for mesh in meshes], lod)
+    return True
+
+
+def cache_is_fresh(model_path, data):
+    magic, version, _, mtime, size, digest, _ = HEADER.unpack_from(data)
+    if magic != MAGIC or version != VERSION:
+        return False
+    if (mtime, size) == source_stamp(model_path):
+        return True
+    return digest == model_hash(model_path)  # touched but not changed
+
+
+def raylib_array(data, offset, length, ctype):
+    """copy a slice of the mapped file into raylib's heap, which owns mesh arrays
+    and frees them in unload_model"""
+    pointer = pr.mem_alloc(length)
+    ffi.memmove(pointer, memoryview(data)[offset : offset + length], length)
+    return ffi.cast(ctype, pointer)
+
+
+def load_cached(model_path, data):
+    _, _, mesh_count, _, _, _, texture_length = HEADER.unpack_from(data)
+    if mesh_count != 1:
+        raise ValueError("only single mesh models are cached")
+    offset = HEADER.size
+    texture = data[offset : offset + texture_length].decode()
+    offset += texture_length
+    count, flags = MESH_HEADER.unpack_from(data, offset)
+    offset += MESH_HEADER.size
+    mesh = ffi.new("Mesh *")
+    mesh.vertexCount = count
+    mesh.triangleCount = count // 3
+    mesh.vertices = raylib_array(data, offset, count * 12, "float *")
+    offset += count * 12
+    if flags & HAS_TEXCOORDS:
+        mesh.texcoords = raylib_array(data, offset, count * 8, "float *")
+        offset += count * 8
+    if flags & HAS_NORMALS:
+        mesh.normals = raylib_array(data, offset, count * 12, "float *")
+    pr.upload_mesh(mesh, False)
+    model = pr.load_model_from_mesh(mesh[0])
+    if texture:
+        model.materials[0].maps[pr.MATERIAL_MAP_ALBEDO].texture = pr.load_texture(
+            os.path.join(os.path.dirname(model_path), texture)
+        )
+    return model
+
+
+def read_cache(model_path, path):
+    """the cached model, or None if the cache is missing, stale or unreadable"""
+    try:
+        with open(path, "rb") as f, mmap.mmap(
+            f.fileno(), 0, access=mmap.ACCESS_READ
+        ) as data:
+            if cache_is_fresh(model_path, data):
+                return load_cached(model_path, data)
+    except FileNotFoundError:
+        pass
+    except (OSError, ValueError, struct.error) as e:
+        print(f"Ignoring mesh cache {path}: {e}")
+    return None
+
+
+def load_model(model_path, lod=0):
+    """load an obj through its memory mapped binary cache, (re)building the cache
+    from the obj when it is missing or stale. Falls back to the plain obj"""
+    path = cache_path(model_path, lod)
+    model = read_cache(model_path, path)
+    if model is not None:
+        return model
+    model = pr.load_model(model_path)
+    try:
+        written = build_cache(model_path, model)
+    except (OSError, ValueError) as e:
+        print(f"Couldn't cache {model_path}: {e}")
+        written = False
+    if not written:
+        # drop a stale cache so later boots don't keep checking it
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+        return model
+    if lod:  # the obj is lod 0, load the decimated mesh that was just written
+        decimated = read_cache(model_path, path)
+        if decimated is not None:
+            pr.unload_model(model)
+            return decimated
+    return model
@@ -0,0 +1,167 @@
+import asyncio
+import random
+
+import aiohttp
+
+import hub_constants
+
+
+def led_state(on_air):
+    return "HIGH" if on_air else "LOW"
+
+
+class OnAirSync:
+    """Keeps the remote on-air light converged on the latest on-air state.
+    Only the desired state is kept: a new edge supersedes (cancels) a request still
+    in flight for the old state, so bouncy switches can't leave the light wrong.
+    Failures retry with jittered exponential backoff, and a heartbeat that slows
+    down while the remote is healthy resends the state in case the remote rebooted.
+
+    When the remote serves a websocket at REMOTE_WS_PATH, one connection is kept
+    open and state changes are pushed over it. Its ping heartbeat detects a lost
+    remote right away, so no polling is needed. The /H and /L GET endpoints are
+    the fallback whenever the channel is down."""
+
+    def __init__(self, session, read_state):
+        self.session = session
+        self.read_state = read_state  # callable returning the current on-air state
+        self.desired = None
+        self.confirmed = None  # last state the remote acknowledged
+        self.connected = False
+        self.failures = 0
+        self.heartbeat = hub_constants.REMOTE_HEARTBEAT_MIN
+        self.wake = asyncio.Event()
+        self.in_flight = None
+        self.in_flight_state = None
+        self.ws = None
+        self.ack = None  # future resolved when the remote echoes the pushed state
+
+    def set_state(self, on_air):
+        self.desired = on_air
+        if self.in_flight and self.in_flight_state != on_air:
+            self.in_flight.cancel()  # superseded by the newer state
+        self.heartbeat = hub_constants.REMOTE_HEARTBEAT_MIN
+        self.wake.set()
+
+    def retry_delay(self):
+        delay = min(
+            hub_constants.REMOTE_RETRY_MIN * 2 ** (self.failures - 1),
+            hub_constants.REMOTE_RETRY_MAX,
+        )
+        return delay * random.uniform(0.5, 1.0)
+
+    async def run(self):
+        self.desired = self.read_state()
+        channel_task = None
+        if hub_constants.REMOTE_WS_ENABLED:
+            channel_task = asyncio.create_task(self.maintain_channel())
+        try:
+            await self.sync_loop()
+        finally:
+            if channel_task:
+                channel_task.cancel()
+
+    async def sync_loop(self):
+        while True:
+            self.wake.clear()
+            if self.desired != self.confirmed:
+                if await self.attempt(self.desired):
+                    self.failures = 0
+                    continue  # the state may have changed while we were sending
+                if self.in_flight_state != self.desired:
+                    continue  # superseded, send the new state right away
+                self.failures += 1
+                self.heartbeat = hub_constants.REMOTE_HEARTBEAT_MIN
+                delay = self.retry_delay()
+            elif self.ws is not None:
+                delay = None  # the channel tells us when something changes
+            else:
+                delay = self.heartbeat
+            try:
+                await asyncio.wait_for(self.wake.wait(), delay)
+            except asyncio.TimeoutError:
+                if self.desired == self.confirmed:
+                    # heartbeat: resend in case the remote lost its state
+                    self.heartbeat = min(
+                        self.heartbeat * 2, hub_constants.REMOTE_HEARTBEAT_MAX
+                    )
+                    self.confirmed = None
+                    self.desired = self.read_state()
+
+    async def attempt(self, on_air):
+        self.in_flight_state = on_air
+        if self.ws is not None:
+            self.in_flight = asyncio.create_task(self.push(on_air))
+        else:
+            self.in_flight = asyncio.create_task(self.send(on_air))
+        # asyncio.wait doesn't raise if the request is cancelled by set_state
+        await asyncio.wait({self.in_flight})
+        ok = not self.in_flight.cancelled() and self.in_flight.result()
+        self.in_flight = None
+        if ok:
+            self.confirmed = on_air
+        return ok
+
+    async def send(self, on_air):
+        endpoint = "/H" if on_air else "/L"
+        try:
+            async with self.session.get(endpoint) as response:
+                await response.read()  # drain the body so the connection is reused
+                self.connected = response.status == 200
+                if not self.connected:
+                    print(
+                        f"Failed to get a valid response. Status code: {response.status}"
+                    )
+        except (aiohttp.ClientError, asyncio.TimeoutError, ConnectionRefusedError):
+            self.connected = False
+        return self.connected
+
+    async def push(self, on_air):
+        self.ack = asyncio.get_running_loop().create_future()
+        try:
+            await self.ws.send_json({"state": led_state(on_air)})
+            await asyncio.wait_for(self.ack, hub_constants.REMOTE_READ_TIMEOUT)
+        except (aiohttp.ClientError, ConnectionResetError, asyncio.TimeoutError):
+            return await self.send(on_air)  # fall back to a plain GET
+        finally:
+            self.ack = None
+        return True
+
+    def handle_message(self, message):
+        led = message.get("led")
+        if led is None:
+            return
+        if self.ack and not self.ack.done() and led == led_state(self.in_flight_state):
+            self.ack.set_result(True)
+        elif self.in_flight is None:
+            # the remote changed on its own (or restarted), reassert our state
+            self.confirmed = led == "HIGH"
+            self.wake.set()
+
+    async def maintain_channel(self):
+        retry = hub_constants.REMOTE_HEARTBEAT_MIN
+        while True:
+            try:
+                async with self.session.ws_connect(
+                    hub_constants.REMOTE_WS_PATH,
+                    heartbeat=hub_constants.REMOTE_WS_HEARTBEAT,
+                ) as ws:
+                    self.ws = ws
+                    self.connected = True
+                    retry = hub_constants.REMOTE_HEARTBEAT_MIN
+                    self.confirmed = None  # resync over the new channel
+                    self.wake.set()
+                    async for msg in ws:
+                        if msg.type == aiohttp.WSMsgType.TEXT:
+                            self.handle_message(msg.json())
+                        elif msg.type == aiohttp.WSMsgType.ERROR:
+                            break
+            except (aiohttp.ClientError, asyncio.TimeoutError, ValueError):
+                pass  # no channel, the GET endpoints keep working
+            if self.ws is not None:
+                self.ws = None
+                self.connected = False
+                self.confirmed = None
+                self.wake.set()  # fall back to GETs right away
+            await asyncio.sleep(retry)
+            retry = min(retry * 2, hub_constants.REMOTE_WS_RETRY_MAX)
@@ -134,7 +134,10 @@ class PinControlPanel:
         # Update
         self.encoder_value = encoder_value
         if hub_constants.DISPLAY_TEST_PANEL:
-            pr.draw_fps(5, 220)
+            frames = self.window.frames
+            pr.draw_text(
+                f"{frames.fps:.0f}/{frames.target_fps} FPS", 5, 220, 10, pr.DARKGREEN
+            )
             pr.draw_line(
                 0,
                 hub_constants.SCREEN_HEIGHT,
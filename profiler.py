@@ -0,0 +1,109 @@
+import json
+import os
+import time
+from collections import deque
+from contextlib import contextmanager
+
+import pyray as pr
+
+import hub_constants
+from file_utils import atomic_write
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, int(fraction * len(sorted_values)))
+    return sorted_values[index]
+
+
+class FrameProfiler:
+    """Times named stages of the render loop. Each stage keeps its last
+    PROFILER_FRAMES per-frame totals in a ring buffer, which the overlay summarises
+    as p50/p95/max and dump() writes to PROFILER_DUMP_DIR for looking at later"""
+
+    def __init__(self, frames=hub_constants.PROFILER_FRAMES):
+        self.frames = frames
+        self.stages = {}  # name: deque of seconds per frame, in first seen order
+        self.current = {}  # name: seconds so far this frame
+        self.frame_start = time.perf_counter()
+        self.visible = hub_constants.PROFILER_OVERLAY
+
+    @contextmanager
+    def scope(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter() - start)
+
+    def record(self, name, seconds):
+        self.current[name] = self.current.get(name, 0) + seconds
+
+    def end_frame(self):
+        now = time.perf_counter()
+        self.record("frame", now - self.frame_start)
+        self.frame_start = now
+        for name, seconds in self.current.items():
+            if name not in self.stages:
+                self.stages[name] = deque(maxlen=self.frames)
+            self.stages[name].append(seconds)
+        self.current = {}
+
+    def summary(self):
+        """{stage: (p50, p95, max)} in milliseconds"""
+        result = {}
+        for name, samples in self.stages.items():
+            ordered = sorted(samples)
+            result[name] = tuple(
+                value * 1000
+                for value in (
+                    percentile(ordered, 0.5),
+                    percentile(ordered, 0.95),
+                    ordered[-1],
+                )
+            )
+        return result
+
+    def draw(self, x=5, y=5):
+        lines = [
+            f"{name:<10}{p50:6.2f}{p95:6.2f}{peak:6.2f}"
+            for name, (p50, p95, peak) in self.summary().items()
+        ]
+        lines.insert(0, f"{'ms':<10}{'p50':>6}{'p95':>6}{'max':>6}")
+        pr.draw_rectangle(x, y, 140, len(lines) * 10 + 4, pr.Color(0, 0, 0, 160))
+        for i, line in enumerate(lines):
+            pr.draw_text(line, x + 2, y + 2 + i * 10, 10, pr.GREEN)
+
+    def dump(self):
+        """write the summary and raw samples, returns the file path"""
+        os.makedirs(hub_constants.PROFILER_DUMP_DIR, exist_ok=True)
+        path = os.path.join(
+            hub_constants.PROFILER_DUMP_DIR,
+            f"profile-{time.strftime('%Y%m%d-%H%M%S')}.json",
+        )
+        data = {
+            "time": time.time(),
+            "summary_ms": self.summary(),
+            "samples_ms": {
+                name: [round(value * 1000, 3) for value in samples]
+                for name, samples in self.stages.items()
+            },
+        }
+        atomic_write(path, json.dumps(data, indent=1))
+        print(f"frame profile written to {path}")
+        self.prune()
+        return path
+
+    def prune(self, keep=hub_constants.PROFILER_DUMP_KEEP):
+        """delete all but the newest keep dumps, the timestamped names sort by age"""
+        dumps = sorted(
+            name
+            for name in os.listdir(hub_constants.PROFILER_DUMP_DIR)
+            if name.startswith("profile-") and name.endswith(".json")
+        )
+        for name in dumps[: max(0, len(dumps) - keep)]:
+            try:
+                os.remove(os.path.join(hub_constants.PROFILER_DUMP_DIR, name))
+            except OSError as e:
+                print(f"Failed to remove old frame profile {name}: {e}")
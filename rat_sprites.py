@@ -0,0 +1,135 @@
+import hashlib
+import math
+import os
+
+import pyray as pr
+
+import hub_constants
+from mesh_cache import model_hash
+
+
+def vec(v):
+    return (v.x, v.y, v.z)
+
+
+class RatSpriteAtlas:
+    """The rat's full rotation rendered once into a sprite sheet, so each frame only
+    blits one cell instead of running a 3D pass. The sheet is saved under
+    RESOURCE_CACHE_DIR, keyed by the model hash and everything that affects the
+    render, and reloaded on later boots."""
+
+    def __init__(
+        self,
+        model,
+        model_path,
+        camera,
+        position,
+        scale,
+        start_rotation,
+        cells=hub_constants.RAT_SPRITE_CELLS,
+        cell_scale=hub_constants.RAT_SPRITE_SCALE,
+    ):
+        self.model = model
+        self.camera = camera
+        self.position = position
+        self.scale = scale
+        self.start_rotation = start_rotation
+        self.cells = cells
+        self.cell_width = int(hub_constants.SCREEN_WIDTH * cell_scale)
+        self.cell_height = int(hub_constants.SCREEN_HEIGHT * cell_scale)
+        self.columns = math.ceil(math.sqrt(cells))
+        self.rows = math.ceil(cells / self.columns)
+        self.step = 360 / cells
+        self.path = os.path.join(
+            hub_constants.RESOURCE_CACHE_DIR,
+            f"rat_atlas_{self.cache_key(model_path)}.png",
+        )
+        self.texture = None
+
+    def cache_key(self, model_path):
+        c = self.camera
+        params = [
+            model_hash(model_path).hex(),
+            hub_constants.RAT_MODEL_LOD,
+            vec(c.position),
+            vec(c.target),
+            vec(c.up),
+            c.fovy,
+            c.projection,
+            vec(self.position),
+            vec(self.scale),
+            self.start_rotation,
+            self.cells,
+            self.cell_width,
+            self.cell_height,
+        ]
+        return hashlib.sha1(repr(params).encode()).hexdigest()[:16]
+
+    def load(self):
+        if os.path.exists(self.path):
+            self.texture = pr.load_texture(self.path)
+            if self.texture.id:
+                return
+        self.bake()
+
+    def bake(self):
+        print(f"baking {self.cells} rat sprites...")
+        cell_render = pr.load_render_texture(self.cell_width, self.cell_height)
+        atlas = pr.gen_image_color(
+            self.columns * self.cell_width, self.rows * self.cell_height, pr.BLANK
+        )
+        cell_rect = pr.Rectangle(0, 0, self.cell_width, self.cell_height)
+        for i in range(self.cells):
+            pr.begin_texture_mode(cell_render)
+            pr.clear_background(pr.Color(255, 255, 255, 0))
+            pr.begin_mode_3d(self.camera)
+            pr.draw_model_ex(
+                self.model,
+                self.position,
+                pr.Vector3(0.0, 1.0, 0.0),
+                self.start_rotation + i * self.step,
+                self.scale,
+                pr.Color(255, 255, 255, 255),
+            )
+            pr.end_mode_3d()
+            pr.end_texture_mode()
+            cell = pr.load_image_from_texture(cell_render.texture)
+            pr.image_flip_vertical(cell)  # render textures are stored upside down
+            x, y = self.cell_origin(i)
+            pr.image_draw(
+                atlas,
+                cell,
+                cell_rect,
+                pr.Rectangle(x, y, self.cell_width, self.cell_height),
+                pr.WHITE,
+            )
+            pr.unload_image(cell)
+        pr.unload_render_texture(cell_render)
+        os.makedirs(hub_constants.RESOURCE_CACHE_DIR, exist_ok=True)
+        pr.export_image(atlas, self.path)
+        self.texture = pr.load_texture_from_image(atlas)
+        pr.unload_image(atlas)
+
+    def cell_origin(self, index):
+        return (
+            (index % self.columns) * self.cell_width,
+            (index // self.columns) * self.cell_height,
+        )
+
+    def draw(self, rotation, tint):
+        """draw the cell closest to rotation over the whole screen"""
+        index = round((rotation - self.start_rotation) % 360 / self.step) % self.cells
+        x, y = self.cell_origin(index)
+        pr.draw_texture_pro(
+            self.texture,
+            pr.Rectangle(x, y, self.cell_width, self.cell_height),
+            pr.Rectangle(0, 0, hub_constants.SCREEN_WIDTH, hub_constants.SCREEN_HEIGHT),
+            pr.Vector2(0, 0),
+            0,
+            tint,
+        )
+
+    def unload(self):
+        if self.texture:
+            pr.unload_texture(self.texture)
+            self.texture = None
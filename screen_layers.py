@@ -0,0 +1,70 @@
+import pyray as pr
+
+
+class RetainedLayer:
+    """One screen element cached in its own render texture. It is only re-rendered
+    when the key describing its inputs changes, every other frame it is a single
+    textured quad. Draw functions keep using screen coordinates, a 2D camera
+    shifts them into the layer"""
+
+    def __init__(self, x, y, width, height):
+        self.x = x
+        self.y = y
+        self.texture = pr.load_render_texture(width, height)
+        # render textures are stored upside down
+        self.source = pr.Rectangle(0, 0, width, -height)
+        self.camera = pr.Camera2D(pr.Vector2(0, 0), pr.Vector2(x, y), 0, 1)
+        self.key = None
+        self.visible = False
+        self.dirty = False  # changed since the screen was last composited
+
+    def update(self, key, draw):
+        """re-render with draw() if key differs from the last render. A key of None
+        hides the layer. Must be called outside any other texture mode"""
+        if key == self.key:
+            return
+        self.key = key
+        self.visible = key is not None
+        self.dirty = True
+        if self.visible:
+            pr.begin_texture_mode(self.texture)
+            pr.clear_background(pr.BLANK)
+            pr.begin_mode_2d(self.camera)
+            draw()
+            pr.end_mode_2d()
+            pr.end_texture_mode()
+
+    def draw(self):
+        self.dirty = False
+        if self.visible:
+            pr.draw_texture_rec(
+                self.texture.texture, self.source, pr.Vector2(self.x, self.y), pr.WHITE
+            )
+
+    def unload(self):
+        pr.unload_render_texture(self.texture)
+
+
+class ScreenLayers:
+    """the retained layers making up the screen, composited in the order added"""
+
+    def __init__(self):
+        self.layers = []
+
+    def add(self, x, y, width, height):
+        layer = RetainedLayer(x, y, width, height)
+        self.layers.append(layer)
+        return layer
+
+    @property
+    def dirty(self):
+        return any(layer.dirty for layer in self.layers)
+
+    def draw(self):
+        for layer in self.layers:
+            layer.draw()
+
+    def unload(self):
+        for layer in self.layers:
+            layer.unload()
+        self.layers = []
@@ -0,0 +1,316 @@
+import asyncio
+import multiprocessing
+from collections import OrderedDict
+
+import album_art
+import hub_constants
+from spotipy_controller import SpotifyController, SpotifyTrack
+from text_cache import TextCache
+
+
+def compact_item(item):
+    """the parts of a track the render loop needs, without markets, urls etc"""
+    return {
+        "id": item["id"],
+        "name": item["name"],
+        "duration_ms": item["duration_ms"],
+        "artists": [{"name": artist["name"]} for artist in item["artists"]],
+        "album": compact_album(item["album"]),
+    }
+
+
+def compact_album(album):
+    return {"id": album["id"], "name": album["name"], "images": album["images"]}
+
+
+class HeadlessSpotifyController(SpotifyController):
+    """SpotifyController running in the worker process. Never draws, it publishes a
+    snapshot of what's playing after every poll and forwards decoded covers."""
+
+    def __init__(self, conn):
+        super().__init__(window=None)
+        self.conn = conn
+        self.acked_seq = 0
+        self.stopped = asyncio.Event()
+        self.album_art.on_decoded = self.send_cover
+
+    async def check_current_playback(self):
+        await super().check_current_playback()
+        self.publish()
+
+    def publish(self):
+        snapshot = None
+        if self.playing:
+            snapshot = {
+                "data": {
+                    "item": compact_item(self.playing.item),
+                    "is_playing": self.playing.is_playing,
+                    "progress_ms": int(self.playing.progress_s * 1000),
+                },
+                "timestamp": self.playing.timestamp,
+                "acked_seq": self.acked_seq,
+                "stats": self.album_art.stats(),
+            }
+            # start the cover download, it arrives through send_cover
+            self.album_art.request(self.playing.album)
+        self.conn.send(("snapshot", snapshot))
+
+    def send_cover(self, album_id, cover):
+        # mapped raw covers can't be pickled, send a copy of the pixels
+        pixels = bytes(cover.pixels)
+        self.conn.send(("cover", album_id, cover.width, cover.height, pixels))
+
+    async def resend_cover(self, album):
+        cover = await self.album_art.request(album)
+        if cover:
+            self.send_cover(album["id"].strip(), cover)
+        else:  # let the render side fall back to its retry backoff
+            self.conn.send(("cover", album["id"].strip(), None))
+
+    def handle_commands(self):
+        try:
+            while self.conn.poll():
+                self.handle_command(*self.conn.recv())
+        except (EOFError, OSError):
+            self.is_updating = False  # the hub went away
+            self.stopped.set()
+
+    def handle_command(self, command, *args):
+        if command == "playback":
+            playing, self.acked_seq = args
+            if self.playing:
+                self.queue_playback_command(playing)
+            self.publish()
+        elif command == "refresh":
+            self.request_refresh()
+        elif command == "cover":
+            asyncio.create_task(self.resend_cover(args[0]))
+        elif command == "stop":
+            self.is_updating = False
+            self.stopped.set()
+
+    async def run(self):
+        try:
+            await self.async_init()
+        except PermissionError as e:
+            self.conn.send(("error", str(e)))
+            return
+        self.conn.send(("ready",))
+        loop = asyncio.get_running_loop()
+        loop.add_reader(self.conn.fileno(), self.handle_commands)
+        self.is_updating = True
+        update_task = asyncio.create_task(self.update_loop())
+        await self.stopped.wait()
+        loop.remove_reader(self.conn.fileno())
+        update_task.cancel()
+        await self.cleanup()
+
+
+def worker_main(conn):
+    try:
+        asyncio.run(HeadlessSpotifyController(conn).run())
+    except (BrokenPipeError, EOFError, KeyboardInterrupt):
+        pass  # the hub went away
+
+
+class RemoteAlbumArt:
+    """Stands in for AlbumArtLoader on the render side. Covers are decoded in the
+    worker and arrive as raw pixels over the pipe"""
+
+    def __init__(self, client):
+        self.client = client
+        self.decoded = OrderedDict()  # album_id: AlbumCover
+        self.waiting = {}  # album_id: (album, [futures])
+        self.stats_text = ""
+
+    def stats(self):
+        return self.stats_text
+
+    def request(self, album):
+        album_id = album["id"].strip()
+        future = asyncio.get_running_loop().create_future()
+        cover = self.decoded.get(album_id)
+        if cover:
+            self.decoded.move_to_end(album_id)
+            future.set_result(cover)
+            return future
+        if album_id not in self.waiting:
+            self.waiting[album_id] = (album, [])
+            self.client.send(("cover", album))
+        self.waiting[album_id][1].append(future)
+        return future
+
+    def receive(self, album_id, cover):
+        """cover is None when the worker failed to load it"""
+        if cover:
+            self.decoded[album_id] = cover
+            while len(self.decoded) > hub_constants.DECODED_COVER_CACHE_SIZE:
+                self.decoded.popitem(last=False)
+            self.client.album_textures.preload(album_id, cover)
+        _, futures = self.waiting.pop(album_id, (None, []))
+        for future in futures:
+            if not future.done():
+                future.set_result(cover)
+
+    def resend_requests(self):
+        for album, _ in self.waiting.values():
+            self.client.send(("cover", album))
+
+
+class SpotifyProcessClient:
+    """Render side of the worker process mode. It has the same interface the hub
+    uses on SpotifyController, but only reads the latest snapshot from the worker
+    once per frame, so slow spotify work never shows up as a dropped frame. If the
+    worker dies the last snapshot keeps being drawn until it is restarted."""
+
+    def __init__(self, window):
+        self.window = window
+        self.playing = None
+        self.displayed_track = None
+        self.is_updating = False
+        self.process = None
+        self.conn = None
+        self.command_seq = 0
+        self.restart_delay = 1
+        self.album_art = RemoteAlbumArt(self)
+        self.album_textures = album_art.AlbumArtAtlas()
+        self.text_cache = TextCache()
+
+    def start_worker(self):
+        context = multiprocessing.get_context("spawn")  # never fork the gl context
+        self.conn, child_conn = context.Pipe()
+        self.process = context.Process(
+            target=worker_main, args=(child_conn,), daemon=True
+        )
+        self.process.start()
+        child_conn.close()
+
+    async def wait_until_ready(self):
+        loop = asyncio.get_running_loop()
+        ready = await loop.run_in_executor(
+            None, self.conn.poll, hub_constants.SPOTIFY_WORKER_START_TIMEOUT
+        )
+        if not ready:
+            raise TimeoutError("spotify worker didn't start in time")
+        message = self.conn.recv()
+        if message[0] == "error":
+            raise PermissionError(message[1])
+
+    async def async_init(self):
+        self.start_worker()
+        try:
+            await self.wait_until_ready()
+        except (EOFError, TimeoutError) as e:
+            self.stop_worker()
+            raise PermissionError(f"spotify worker failed to start: {e}") from e
+
+    def send(self, message):
+        try:
+            self.conn.send(message)
+        except (BrokenPipeError, OSError):
+            pass  # the worker is restarting, update_loop will notice
+
+    def stop_worker(self):
+        self.send(("stop",))
+        self.process.join(timeout=2)
+        if self.process.is_alive():
+            self.process.terminate()
+        self.conn.close()
+
+    async def update_loop(self):
+        # supervise the worker, restarting it with backoff if it crashes
+        while self.is_updating:
+            await asyncio.sleep(1)
+            if self.process.is_alive():
+                continue
+            print(f"spotify worker exited ({self.process.exitcode}), restarting")
+            self.conn.close()
+            await asyncio.sleep(self.restart_delay)
+            self.restart_delay = min(
+                self.restart_delay * 2, hub_constants.SPOTIFY_WORKER_RESTART_MAX
+            )
+            self.start_worker()
+            try:
+                await self.wait_until_ready()
+            except (EOFError, TimeoutError, PermissionError) as e:
+                print(f"spotify worker failed to restart: {e}")
+                continue
+            self.restart_delay = 1
+            self.album_art.resend_requests()
+
+    def drain(self):
+        """handle everything the worker sent since the last frame, keeping only the
+        latest snapshot"""
+        snapshot = False
+        try:
+            while self.conn.poll():
+                message = self.conn.recv()
+                if message[0] == "snapshot":
+                    snapshot = message[1]
+                elif message[0] == "cover" and message[2] is None:
+                    self.album_art.receive(message[1], None)  # the worker gave up
+                elif message[0] == "cover":
+                    album_id, width, height, pixels = message[1:]
+                    self.album_art.receive(
+                        album_id, album_art.AlbumCover(width, height, pixels)
+                    )
+        except (EOFError, OSError):
+            pass  # worker died mid-message, the supervisor restarts it
+        if snapshot is not False:
+            self.apply_snapshot(snapshot)
+
+    def apply_snapshot(self, snapshot):
+        if snapshot is None:
+            self.set_playing(None)
+            self.displayed_track = None
+            return
+        self.album_art.stats_text = snapshot["stats"]
+        data = snapshot["data"]
+        if snapshot["acked_seq"] < self.command_seq and self.playing:
+            # the worker hasn't seen our last button press yet, keep the local state
+            data = dict(data, is_playing=self.playing.is_playing)
+        if self.playing and self.playing.id == data["item"]["id"].strip():
+            self.playing.update(data)
+        else:
+            self.set_playing(SpotifyTrack(controller=self, data=data))
+        self.playing.timestamp = snapshot["timestamp"]
+        self.playing.infer_progress()
+
+    def set_playing(self, track):
+        if self.playing:
+            self.playing.release()
+        self.playing = track
+
+    def request_refresh(self):
+        self.send(("refresh",))
+
+    def display_track(self, panel, progress_bar):
+        self.drain()
+        if self.playing:
+            self.playing.update_layers(panel, progress_bar)
+            self.displayed_track = self.playing
+        else:
+            panel.update(None, None)
+            progress_bar.update(None, None)
+
+    def toggle_playback(self):
+        if self.playing:
+            playing = not self.playing.is_playing
+            self.playing.set_is_playing(playing)
+            self.command_seq += 1
+            self.send(("playback", playing, self.command_seq))
+
+    def pause_playback(self):
+        if self.playing and self.playing.is_playing:
+            self.toggle_playback()
+
+    def start_playback(self):
+        if self.playing and not self.playing.is_playing:
+            self.toggle_playback()
+
+    async def cleanup(self):
+        self.is_updating = False
+        self.set_playing(None)
+        self.album_textures.clear()
+        self.text_cache.clear()
+        self.stop_worker()
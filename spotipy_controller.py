@@ -1,19 +1,25 @@
 import asyncio
-import io
 import json
 import os
 import time
 
-import requests
+import aiohttp
 import pyray as pr
-from PIL import Image
 from async_spotify.authentification.authorization_flows import AuthorizationCodeFlow
 from async_spotify.authentification import SpotifyAuthorisationToken
 from async_spotify import SpotifyApiClient, TokenRenewClass
-from async_spotify.spotify_errors import SpotifyError, SpotifyAPIError
+from async_spotify.api._endpoints.urls import URLS
+from async_spotify.spotify_errors import (
+    RateLimitExceeded,
+    SpotifyBaseError,
+    SpotifyError,
+)
 
 
+import album_art
 import hub_constants
+from file_utils import atomic_write
+from text_cache import Marquee, TextCache
 
 
 class SpotifyController:
@@ -31,8 +37,37 @@ class SpotifyController:
         self.auth_token = None
         self.renew_token = TokenRenewClass()
         self.is_updating = False
+        self.last_checked = 0
+        self.refresh_task = None
+        self.refresh_event = asyncio.Event()
+        self.idle_delay = hub_constants.SPOTIFY_POLL_IDLE_MIN
+        self.rate_limited_until = 0
+        # playback commands: buttons set the desired state, one task applies it
+        self.desired_playing = None  # None when no command is outstanding
+        self.confirmed_playing = None  # last state spotify reported or accepted
+        self.command_event = asyncio.Event()
+        self.command_in_flight = False
+        self.command_completed_at = 0
+        self.command_task = None
+        self.token_task = None
+        self.queue_task = None
+        self.album_art = album_art.AlbumArtLoader()
+        self.album_textures = album_art.AlbumArtAtlas()
+        # prefetched covers go straight into spare atlas slots
+        self.album_art.on_decoded = self.album_textures.preload
+        self.text_cache = TextCache()  # the playing track's rendered text
 
     async def cleanup(self):
+        if self.command_task:
+            self.command_task.cancel()
+        if self.token_task:
+            self.token_task.cancel()
+        if self.queue_task:
+            self.queue_task.cancel()
+        self.set_playing(None)
+        self.album_textures.clear()
+        self.text_cache.clear()
+        await self.album_art.close()
         await self.api_client.close_client()
 
     async def async_init(self):
@@ -46,8 +81,11 @@ class SpotifyController:
         )
         await self.api_client.create_new_client()
         if self.auth_token.is_expired():
-            await self.api_client.refresh_token(self.auth_token)
-        await self.check_current_playback()
+            await self.refresh_auth_token()
+        self.token_task = asyncio.create_task(self.token_refresh_loop())
+        await self.album_art.start()
+        await self.refresh()
+        self.command_task = asyncio.create_task(self.playback_command_loop())
 
     async def get_token(self):
         auth_token = self.check_token_cache()
@@ -79,43 +117,155 @@ class SpotifyController:
         if os.path.exists(hub_constants.SPOTIFY_CACHE):
             with open(hub_constants.SPOTIFY_CACHE, "r", encoding="utf-8") as f:
                 data = f.read()
-                if data:
-                    data = json.loads(data)
-                else:
-                    data = None  # not valid
+            try:
+                data = json.loads(data)
+            except ValueError:
+                data = None  # empty or partially written
             required_keys = ["access_token", "refresh_token", "activation_time"]
-            if all(key in data for key in required_keys):
+            if isinstance(data, dict) and all(key in data for key in required_keys):
                 return SpotifyAuthorisationToken(
                     data["refresh_token"], data["activation_time"], data["access_token"]
                 )
-            else:
-                # bad cache, delete it
-                raise ValueError("Bad cache data")
-                # os.remove(hub_constants.SPOTIFY_CACHE)
+            # bad cache, fall back to the auth code flow
+            print(f"Ignoring bad token cache in {hub_constants.SPOTIFY_CACHE}")
         return None
 
+    def save_token(self, token):
+        # write-and-rename so a crash mid-write can't leave a partial cache
+        atomic_write(hub_constants.SPOTIFY_CACHE, json.dumps(token.__dict__))
+
     async def new_oauth(self, auth_code, api_client=None):
         if not api_client:
             api_client = self.api_client
         token = await api_client.get_auth_token_with_code(auth_code)
-        # cache the token
-        with open(hub_constants.SPOTIFY_CACHE, "w", encoding="utf-8") as f:
-            f.write(json.dumps(token.__dict__))
+        self.save_token(token)
         return token
 
+    async def refresh_auth_token(self):
+        """returns whether a new token came back"""
+        token = await self.api_client.refresh_token(self.auth_token)
+        if token:
+            self.auth_token = token
+            self.save_token(token)
+        return bool(token)
+
+    async def token_refresh_loop(self):
+        """refresh the token a margin before it expires, so no play/pause or poll
+        has to wait for an oauth round trip"""
+        while True:
+            refresh_at = (
+                self.auth_token.activation_time
+                + hub_constants.SPOTIFY_TOKEN_LIFETIME
+                - hub_constants.SPOTIFY_TOKEN_REFRESH_MARGIN
+            )
+            await asyncio.sleep(max(0, refresh_at - time.time()))
+            try:
+                if await self.refresh_auth_token():
+                    continue
+                print("Token refresh returned no token")
+            except (SpotifyBaseError, aiohttp.ClientError, asyncio.TimeoutError) as e:
+                print(f"Token refresh failed: {e}")
+            # the old token's refresh time has passed, don't retry straight away
+            await asyncio.sleep(hub_constants.SPOTIFY_TOKEN_RETRY)
+
     async def check_current_playback(self):
+        polled_at = time.time()
         data = await self.api_client.player.get_queue()  # get_queue
         self.last_checked = time.time()
         if data:
+            data = dict(
+                data, is_playing=self.reconcile_playback(data["is_playing"], polled_at)
+            )
             track_id = str(data["item"]["id"]).strip()
             if self.playing and self.playing.id == track_id:
                 self.playing.update(data)
             else:
-                self.playing = SpotifyTrack(controller=self, data=data)
+                self.set_playing(SpotifyTrack(controller=self, data=data))
+                self.fetch_queue()
         else:
-            self.playing = None
+            self.set_playing(None)
             self.displayed_track = None
 
+    def fetch_queue(self):
+        """look up what plays next once per track change, the playback state polled
+        above doesn't include the queue"""
+        if self.queue_task:
+            self.queue_task.cancel()
+        self.queue_task = asyncio.create_task(self.prefetch_queue())
+
+    async def prefetch_queue(self):
+        # warm the cover caches for the next few tracks so track changes are instant
+        try:
+            # player.get_queue() is really /me/player, ask for /me/player/queue
+            data = await self.api_client.player.api_request_handler.make_request(
+                "GET", URLS.PLAYER.QUEUE, {}, self.auth_token
+            )
+        except RateLimitExceeded as e:
+            self.rate_limited(e)
+            return
+        except (SpotifyBaseError, aiohttp.ClientError, asyncio.TimeoutError) as e:
+            print(f"Spotify queue lookup failed: {e}")
+            return
+        upcoming = (data or {}).get("queue") or []
+        playing_album = self.playing.album_id if self.playing else None
+        albums = [
+            item["album"]
+            for item in upcoming[: hub_constants.PREFETCH_QUEUE_DEPTH]
+            if item
+            and item.get("album")  # episodes have no album
+            and item["album"]["id"].strip() != playing_album
+        ]
+        self.album_art.prefetch(albums)
+
+    def set_playing(self, track):
+        # release the old track's cover now instead of whenever it gets collected
+        if self.playing:
+            self.playing.release()
+        self.playing = track
+
+    def refresh(self):
+        """start a playback check unless one is already in flight, so only one
+        get_queue call is ever outstanding. Returns the in-flight task"""
+        if self.refresh_task is None or self.refresh_task.done():
+            self.refresh_task = asyncio.create_task(self.rate_limited_refresh())
+        return self.refresh_task
+
+    async def rate_limited_refresh(self):
+        wait = self.rate_limited_until - time.time()
+        if wait > 0:
+            await asyncio.sleep(wait)
+        try:
+            await self.check_current_playback()
+        except RateLimitExceeded as e:
+            self.rate_limited(e)
+
+    def rate_limited(self, error):
+        """hold off every poll for as long as the 429 asked"""
+        delay = error.retry_after or hub_constants.SPOTIFY_RATE_LIMIT_DEFAULT
+        print(f"Spotify rate limit hit, waiting {delay}s")
+        self.rate_limited_until = time.time() + delay
+
+    def request_refresh(self):
+        """wake the update loop early, e.g. when a track should have ended"""
+        self.refresh_event.set()
+
+    def next_poll_delay(self):
+        if self.playing and self.playing.is_playing:
+            self.idle_delay = hub_constants.SPOTIFY_POLL_IDLE_MIN
+            self.playing.infer_progress()
+            remaining = self.playing.duration_s - self.playing.progress_inferred
+            # poll sparsely mid-track but wake up right as the track ends
+            delay = min(
+                hub_constants.SPOTIFY_POLL_MID_TRACK,
+                remaining + hub_constants.SPOTIFY_TRACK_END_SLACK,
+            )
+        else:  # paused or idle, back off exponentially
+            delay = self.idle_delay
+            self.idle_delay = min(
+                self.idle_delay * 2, hub_constants.SPOTIFY_POLL_IDLE_MAX
+            )
+        return max(delay, hub_constants.SPOTIFY_POLL_MIN)
+
     def start_updating(self):
         self.is_updating = True
         asyncio.create_task(self.update_loop())
@@ -125,16 +275,33 @@ class SpotifyController:
 
     async def update_loop(self):
         while self.is_updating:
-            await self.check_current_playback()
-            if self.playing:
-                await asyncio.sleep(3)
-            else:
-                await asyncio.sleep(10)  # check less often if nothing's playing
+            self.refresh_event.clear()
+            try:
+                await self.refresh()
+                delay = self.next_poll_delay()
+            except (SpotifyBaseError, aiohttp.ClientError, asyncio.TimeoutError) as e:
+                print(f"Spotify playback check failed: {e}")
+                delay = self.idle_delay
+                self.idle_delay = min(
+                    self.idle_delay * 2, hub_constants.SPOTIFY_POLL_IDLE_MAX
+                )
+            delay = max(delay, self.rate_limited_until - time.time())
+            try:
+                await asyncio.wait_for(self.refresh_event.wait(), delay)
+            except asyncio.TimeoutError:
+                pass
+            # an early wake up still respects the minimum poll interval
+            wait = self.last_checked + hub_constants.SPOTIFY_POLL_MIN - time.time()
+            if wait > 0:
+                await asyncio.sleep(wait)
 
-    def display_track(self):
+    def display_track(self, panel, progress_bar):
         if self.playing:
-            self.playing.draw_track_info()
+            self.playing.update_layers(panel, progress_bar)
             self.displayed_track = self.playing
+        else:
+            panel.update(None, None)
+            progress_bar.update(None, None)
 
     def toggle_playback(self):
         if self.playing:
@@ -145,25 +312,60 @@ class SpotifyController:
 
     def pause_playback(self):
         if self.playing and self.playing.is_playing:
-            asyncio.create_task(self.pause())
-
-    async def pause(self):
-        try:
-            await self.api_client.player.pause()
-        except SpotifyAPIError:
-            print("Attempted to pause but failed.")
-        self.playing.is_playing = False
+            self.queue_playback_command(False)
 
     def start_playback(self):
         if self.playing and not self.playing.is_playing:
-            asyncio.create_task(self.play())
+            self.queue_playback_command(True)
+
+    def queue_playback_command(self, playing):
+        """show the new state right away and let the command loop catch spotify up.
+        Presses that arrive while a call is in flight collapse into the net state"""
+        self.playing.set_is_playing(playing)
+        self.desired_playing = playing
+        self.command_event.set()
+
+    async def playback_command_loop(self):
+        while True:
+            await self.command_event.wait()
+            self.command_event.clear()
+            desired = self.desired_playing
+            if desired is None or desired == self.confirmed_playing:
+                continue  # toggled back to where spotify already is
+            self.command_in_flight = True
+            try:
+                if desired:
+                    await self.play()
+                else:
+                    await self.pause()
+                self.confirmed_playing = desired
+            except (SpotifyBaseError, aiohttp.ClientError, asyncio.TimeoutError):
+                print(f"Attempted to {'play' if desired else 'pause'} but failed.")
+            finally:
+                self.command_in_flight = False
+                self.command_completed_at = time.time()
+            self.request_refresh()  # reconcile with what spotify actually did
+
+    def reconcile_playback(self, remote_playing, polled_at):
+        """returns the is_playing state to show for a poll that started at polled_at.
+        The optimistic state is kept until spotify agrees, or until a poll that
+        started after the last command finished says otherwise"""
+        fresh = not self.command_in_flight and polled_at > self.command_completed_at
+        if fresh:
+            self.confirmed_playing = remote_playing
+        if self.desired_playing is None:
+            return remote_playing
+        settled = fresh and not self.command_event.is_set()
+        if remote_playing == self.desired_playing or settled:
+            self.desired_playing = None
+            return remote_playing
+        return self.desired_playing
+
+    async def pause(self):
+        await self.api_client.player.pause()
 
     async def play(self):
-        try:
-            await self.api_client.player.play()
-        except SpotifyAPIError:
-            print("Attempted to play but failed.")
-        self.playing.is_playing = True
+        await self.api_client.player.play()
 
 
 class SpotifyTrack:
@@ -185,12 +387,18 @@ class SpotifyTrack:
         self.timestamp = time.time()  # assume latency is negligible
         self.progress_inferred = self.progress_s
         self.inference_diff = 0
-        self.cached_cover = f"./{hub_constants.IMAGE_CACHE_DIR}/{self.album_id}.jpg"
-        self.album_texture = None
+        self.cover_slot = None  # where the cover sits in the album art atlas
+        self.cover_task = None
+        self.cover_retry_time = 0
+        self.end_refresh_requested = False
+        self.text_lines = None  # (marquee, y offset), rendered on first display
 
-    def __del__(self):
-        if self.album_texture:
-            pr.unload_texture(self.album_texture)
+    def release(self):
+        if self.cover_slot:
+            self.controller.album_textures.release(self.album_id)
+            self.cover_slot = None
+        self.text_lines = None
+        self.controller.text_cache.clear()
 
     def update(self, data):
         # if we are here then the same track was just playing
@@ -198,24 +406,47 @@ class SpotifyTrack:
         self.timestamp = time.time()
         self.is_playing = data["is_playing"]
         self.inference_diff = self.progress_inferred - self.progress_s
+        self.end_refresh_requested = False
         self.infer_progress()
 
-    def cache_album_art(self):
-        os.makedirs(f"./{hub_constants.IMAGE_CACHE_DIR}/", exist_ok=True)
-        cover_url = sorted(self.album["images"], key=lambda x: x["height"])[2]["url"]
-        img_data = requests.get(cover_url, timeout=10).content
-        with Image.open(io.BytesIO(img_data)) as im:
-            im.thumbnail(hub_constants.ALBUM_RESOLUTION)
-            im.save(f"./{hub_constants.IMAGE_CACHE_DIR}/{self.album_id}.jpg")
+    def set_is_playing(self, playing):
+        # freeze or restart progress inference from where it is now
+        self.infer_progress()
+        self.progress_s = self.progress_inferred
+        self.timestamp = time.time()
+        self.is_playing = playing
+
+    def load_album_art(self):
+        """kicks off the cover download and uploads the texture on the first frame
+        after the pixels are ready. Never blocks the render loop"""
+        textures = self.controller.album_textures
+        if self.cover_task is None:
+            self.cover_slot = textures.acquire(self.album_id)
+            if self.cover_slot or time.time() < self.cover_retry_time:
+                return
+            # prefetched covers come back already resolved and upload this frame
+            self.cover_task = self.controller.album_art.request(self.album)
+        if not self.cover_task.done():
+            return
+        cover = None if self.cover_task.cancelled() else self.cover_task.result()
+        if cover:
+            self.cover_slot = textures.acquire(self.album_id, cover)
+        else:
+            self.cover_retry_time = time.time() + hub_constants.ALBUM_ART_RETRY
+        self.cover_task = None
 
     def infer_progress(self):
         if self.is_playing:
             self.progress_inferred = min(
                 self.progress_s + (time.time() - self.timestamp), self.duration_s
             )
-            if self.progress_inferred == self.duration_s:
-                # check for next song
-                asyncio.create_task(self.controller.check_current_playback())
+            if (
+                self.progress_inferred == self.duration_s
+                and not self.end_refresh_requested
+            ):
+                # check for next song, once per track end
+                self.end_refresh_requested = True
+                self.controller.request_refresh()
 
     def draw_time_debug(self):
         pr.draw_text(
@@ -239,30 +470,85 @@ class SpotifyTrack:
             5,
             pr.BLACK,
         )
-
-    def draw_track_info(self, x=10, x_padding=10, y_padding=25):
-        if not self.album_texture:
-            self.cache_album_art()
-            self.album_texture = pr.load_texture(self.cached_cover)
-        y = hub_constants.SCREEN_HEIGHT - y_padding - self.album_texture.height
-        pr.draw_texture_rec(
-            self.album_texture,
-            pr.Rectangle(0, 0, self.album_texture.width, self.album_texture.height),
-            pr.Vector2(x, y),
-            pr.WHITE,
+        pr.draw_text(
+            self.controller.album_art.stats(),
+            10,
+            65,
+            5,
+            pr.BLACK,
         )
-        text_x = x + self.album_texture.width + x_padding
-        pr.draw_text(self.title, text_x, y + 5, 8, pr.BLACK)
-        pr.draw_text(self.artists, text_x, y + 15, 7, pr.BLACK)
-        pr.draw_text(self.album_title, text_x, y + 30, 6, pr.BLACK)
 
-        if self.window.debug and hub_constants.DISPLAY_TEST_PANEL:
-            self.draw_time_debug()
+    @staticmethod
+    def layout(x=10, x_padding=10, y_padding=25):
+        """the cover sits in the bottom left, text and progress bar right of it.
+        Returns the cover position, where the text starts and the bar length"""
+        width, height = hub_constants.ALBUM_RESOLUTION
+        y = hub_constants.SCREEN_HEIGHT - y_padding - height
+        text_x = x + width + x_padding
+        return x, y, text_x, hub_constants.SCREEN_WIDTH - text_x - x_padding
+
+    @staticmethod
+    def panel_bounds():
+        _, y, _, _ = SpotifyTrack.layout()
+        height = hub_constants.ALBUM_RESOLUTION[1]
+        return 0, y, hub_constants.SCREEN_WIDTH, height
 
+    @staticmethod
+    def progress_bounds():
+        # leave room for the knob's radius around the bar
+        _, y, text_x, bar_length = SpotifyTrack.layout()
+        return text_x - 5, y + 55, bar_length + 10, 12
+
+    def update_layers(self, panel, progress_bar):
+        """re-render the cached panel and progress bar when what they show changed"""
+        if not self.cover_slot:
+            self.load_album_art()
+        if self.text_lines is None:
+            self.text_lines = self.layout_text()
         self.infer_progress()
-        bar_length = hub_constants.SCREEN_WIDTH - text_x - x_padding
+        panel.update((self.id, self.cover_slot is not None), self.draw_panel)
+        progress_bar.update(self.progress_pixels(), self.draw_progress)
+
+    def draw_panel(self):
+        x, y, text_x, _ = self.layout()
+        if self.cover_slot:
+            self.cover_slot.draw(x, y)
+        else:  # placeholder until the cover is ready
+            width, height = hub_constants.ALBUM_RESOLUTION
+            pr.draw_rectangle(x, y, width, height, pr.LIGHTGRAY)
+        for line, line_y in self.text_lines:
+            if not line.scrolling:
+                line.draw(text_x, y + line_y)
+
+    def layout_text(self):
+        _, _, _, max_width = self.layout()
+        cache = self.controller.text_cache
+        return [
+            (Marquee(cache, self.title, 8, pr.BLACK, max_width), 5),
+            (Marquee(cache, self.artists, 7, pr.BLACK, max_width), 15),
+            (Marquee(cache, self.album_title, 6, pr.BLACK, max_width), 30),
+        ]
+
+    def text_animating(self):
+        """whether a long line is scrolling right now, rather than resting"""
+        return any(line.offset() for line, _ in self.text_lines or [])
+
+    def draw_scrolling_text(self):
+        """lines too long for the panel move every frame, so they are drawn over
+        the cached panel instead of being part of it"""
+        _, y, text_x, _ = self.layout()
+        for line, line_y in self.text_lines or []:
+            if line.scrolling:
+                line.draw(text_x, y + line_y)
+
+    def progress_pixels(self):
+        _, _, _, bar_length = self.layout()
+        return int(self.progress_inferred / self.duration_s * bar_length)
+
+    def draw_progress(self):
+        _, y, text_x, bar_length = self.layout()
         bar_y = y + 60
-        progress_pixels = int(self.progress_inferred / self.duration_s * bar_length)
+        progress_pixels = self.progress_pixels()
         # pr.draw_triangle()
         pr.draw_rectangle(text_x, bar_y, bar_length, 3, pr.BLACK)  # full bar
         pr.draw_rectangle(text_x, bar_y, progress_pixels, 4, pr.DARKBLUE)
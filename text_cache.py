@@ -0,0 +1,77 @@
+import time
+
+import pyray as pr
+
+import hub_constants
+
+
+class TextCache:
+    """Text rendered once into a texture per unique (string, size, color), so
+    drawing it again is one textured quad instead of re-laying out every glyph.
+    image_text uses the same default font and spacing as draw_text"""
+
+    def __init__(self):
+        self.textures = {}
+
+    def get(self, text, size, color):
+        key = (text, size, (color.r, color.g, color.b, color.a))
+        texture = self.textures.get(key)
+        if texture is None:
+            image = pr.image_text(text, size, color)
+            texture = pr.load_texture_from_image(image)
+            pr.unload_image(image)
+            self.textures[key] = texture
+        return texture
+
+    def clear(self):
+        for texture in self.textures.values():
+            pr.unload_texture(texture)
+        self.textures = {}
+
+
+class Marquee:
+    """One line of cached text clipped to max_width. Text that doesn't fit scrolls
+    left through the clip by shifting the pre-rendered strip, resting at the start
+    for MARQUEE_PAUSE seconds every lap"""
+
+    def __init__(self, cache, text, size, color, max_width):
+        self.texture = cache.get(text, size, color)
+        self.max_width = max_width
+        self.started = time.monotonic()
+
+    @property
+    def scrolling(self):
+        return self.texture.width > self.max_width
+
+    def offset(self):
+        """pixels scrolled so far in the current lap"""
+        if not self.scrolling:
+            return 0
+        lap = self.texture.width + hub_constants.MARQUEE_GAP
+        pause = hub_constants.MARQUEE_PAUSE
+        elapsed = (time.monotonic() - self.started) % (
+            pause + lap / hub_constants.MARQUEE_SPEED
+        )
+        return max(0, int((elapsed - pause) * hub_constants.MARQUEE_SPEED))
+
+    def draw(self, x, y):
+        width, height = self.texture.width, self.texture.height
+        offset = self.offset()
+        # the strip repeats every lap, draw the tail of this copy then the next one
+        visible = min(width - offset, self.max_width)
+        if visible > 0:
+            pr.draw_texture_rec(
+                self.texture,
+                pr.Rectangle(offset, 0, visible, height),
+                pr.Vector2(x, y),
+                pr.WHITE,
+            )
+        if self.scrolling:
+            next_x = width + hub_constants.MARQUEE_GAP - offset
+            if next_x < self.max_width:
+                pr.draw_texture_rec(
+                    self.texture,
+                    pr.Rectangle(0, 0, self.max_width - next_x, height),
+                    pr.Vector2(x + next_x, y),
+                    pr.WHITE,
+                )